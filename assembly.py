@@ -2,12 +2,24 @@
 #
 #
 
-from isa6502 import ISA
+from isa6502 import ISA, OPCODES, MNEMONIC_MODES, OPERAND_SIZES, ADDRMODES, OPCODE_ADDRMODE, OPCODE_LENGTH, CYCLES, mnemonic_to_opcode
 import re
-from lark import Lark, Transformer, v_args, Tree
-from lark.exceptions import VisitError
-import intelhex
+import sys
 import io
+import os
+import hashlib
+import json
+import functools
+import itertools
+import bisect
+import struct
+from array import array
+import operator
+import contextlib
+import time
+import tracemalloc
+from pathlib import Path
+from batch import format_error
 
 LOCAL_LABEL_PREFIX = '.'
 
@@ -48,16 +60,9 @@ def operand_to_str(addrmode,operand):
     return arg
 
 def operand_size(addrmode):
-    # no operand
-    if addrmode == "i" or addrmode == "A":
-        return 0
-    # 1-Byte operand
-    elif addrmode in ["#", "r", "zp", "(zp,x)", "zp,x", "zp,y", "(zp)", "(zp),y"]:
-        return 1
-    # 2-Byte operand
-    elif addrmode in ["a", "(a,x)", "a,x", "a,y", "(a)"]:
-        return 2
-    else:
+    try:
+        return OPERAND_SIZES[addrmode]
+    except KeyError:
         raise Exception("Invalid addressing mode:",addrmode)
 
 def opcode_to_instr(op):
@@ -69,47 +74,43 @@ def opcode_to_instr(op):
 
 def identify_opcode(mnemonic,argfmt):
 
-    mnematches = [(o,i) for o,i in ISA.items() if len(i)>0 and i[0]==mnemonic]
+    modes = MNEMONIC_MODES.get(mnemonic)
 
-    if len(mnematches) == 0:
+    if modes is None:
         raise SyntaxError(f"Unknown instruction mnemonic: {mnemonic}")
 
-    # try to match address mode
-    possible_modes = [argfmt]
+    # try to match address mode, falling back from zp to a to r
+    if argfmt in modes:
+        return modes[argfmt]
 
     if 'zp' in argfmt:
-        possible_modes.append(argfmt.replace("zp","a"))
-
-    if "zp" in possible_modes or "a" in possible_modes:
-        possible_modes.append("r")
-
-    matches = [o  for m in possible_modes for o,i in mnematches if i[1] == m]
+        absolute_fmt = argfmt.replace("zp","a")
+        if absolute_fmt in modes:
+            return modes[absolute_fmt]
 
-    if len(matches) == 0:
-        raise SyntaxError(f"Unknown instruction: {mnemonic} {argfmt}")
+    if argfmt in ("zp", "a") and "r" in modes:
+        return modes["r"]
 
-    return matches[0]
+    if argfmt in ("(a)", "(a,x)"):
+        # label operands of zero page only modes, checked once resolved
+        zero_page_fmt = argfmt.replace("a", "zp", 1)
+        if zero_page_fmt in modes:
+            return modes[zero_page_fmt]
 
-def mnemonic_to_opcode(mnemonic):
-    matches = [o for o,instr in ISA.items() if instr[0]==mnemonic]
-    if len(matches) != 1:
-        raise Exception(f"No unique matching instruction with mnemonic {mnemonic}: {matches}")
-
-    return matches[0]
+    raise SyntaxError(f"Unknown instruction: {mnemonic} {argfmt}")
 
 def word_to_bytes(word):
     return [word & 0xff, (word >>8) & 0xff]
 
 class Instruction:
+    __slots__ = ('_opcode', '_context', '_operand')
+
     def __init__(self, opcode, operand, context, current_nonlocal_label):
         self._opcode = opcode
-        self._address = None
         self._context = context
 
-        if isinstance(operand, Tree):
-            for label_tok in operand.scan_values(lambda v: v.type == 'LABEL'):
-                if re.match(re.escape(LOCAL_LABEL_PREFIX),label_tok.value[0]):
-                    label_tok.value = current_nonlocal_label+label_tok.value
+        if isinstance(operand, Expression):
+            operand = operand.with_local_labels(current_nonlocal_label, context)
 
         self._operand = operand
 
@@ -126,8 +127,7 @@ class Instruction:
         return myop[0]
 
     def size(self):
-        myop = ISA[self._opcode]
-        return 1+operand_size(self.get_addrmode())
+        return OPCODE_LENGTH[self._opcode]
 
     def encode(self):
         bs = [self._opcode]
@@ -139,37 +139,10 @@ class Instruction:
             bs.extend(word_to_bytes(self._operand))
         return bs
 
-    def set_address(self, my_address):
-        self._address = my_address
-
-    def resolve_labels(self,label_addresses):
-        if self._address is None:
-            raise RuntimeError('resolve_labels requires address to be set')
-
-        if isinstance(self._operand, Tree):
-            try:
-                self._operand = evaluate_expression(self._operand, label_addresses)
-            except SyntaxError as e:
-                e.set_context(self._context)
-                raise e
-
-        if self.get_addrmode() == "r":
-            # special case for program-counter-relative address mode
-
-            # pc is incremented before jump, add size of this instruction
-            pc_address = (self._address+self.size())
-
-            branch_offset = self._operand - pc_address
-
-            if branch_offset > 127 or branch_offset < -128:
-                raise SyntaxError("Out of range branch (branches are limited to -128 to +127)", self._context)
-
-            branch_offset = (branch_offset+256) % 256 # convert to unsigned
-
-            self._operand = branch_offset
-
 
 class ByteData:
+    __slots__ = ('_bytes',)
+
     def __init__(self,bs):
         self._bytes = bs
 
@@ -179,16 +152,13 @@ class ByteData:
     def size(self):
         return len(self._bytes)
 
-    def set_address(self, my_address):
-        pass
-
     def encode(self):
         return self._bytes
 
-    def resolve_labels(self, label_addresses):
-        pass
 
 class WordData:
+    __slots__ = ('_words',)
+
     def __init__(self,ws):
         self._words = ws
 
@@ -198,126 +168,505 @@ class WordData:
     def size(self):
         return len(self._words) * 2
 
-    def set_address(self, my_address):
-        pass
-
     def encode(self):
         bs = []
         for w in self._words:
             bs.extend(word_to_bytes(w))
         return bs
 
-    def resolve_labels(self, label_addresses):
-        for i in range(len(self._words)):
-            self._words[i] = evaluate_expression(self._words[i], label_addresses)
+class LongBranch:
+    """A conditional branch rewritten as an inverted branch over a JMP, see relax_branches."""
+    __slots__ = ('_opcode', '_target', '_context')
+
+    def __init__(self, opcode, target, context):
+        self._opcode = opcode
+        self._target = target
+        self._context = context
+
+    def __str__(self):
+        inverted_opcode, inverted_mnemonic = INVERTED_BRANCHES[self._opcode]
+        return f"{inverted_mnemonic} +3 / JMP ${self._target:04x}"
+
+    def get_addrmode(self):
+        return 'r'
+
+    def get_mnemonic(self):
+        return ISA[self._opcode][0]
+
+    def size(self):
+        return LONG_BRANCH_SIZE
+
+    def encode(self):
+        inverted_opcode, _ = INVERTED_BRANCHES[self._opcode]
+        return [inverted_opcode, 3, JMP_ABSOLUTE] + word_to_bytes(self._target)
+
+
+# ===================================================================
+# Statement store
+# ===================================================================
+
+STMT_INSTRUCTION = 0
+STMT_BYTES = 1
+STMT_WORDS = 2
+
+RELATIVE_ADDRMODE = ADDRMODES.index('r')
+
+# Branch relaxation, see relax_branches. Conditional branches are
+# rewritten as the inverted branch over a JMP to the target, so
+# relaxed branches keep their opcode with size LONG_BRANCH_SIZE and the
+# absolute target as operand. BRA simply becomes a JMP.
+JMP_ABSOLUTE = OPCODES[('JMP', 'a')]
+BRA = OPCODES[('BRA', 'r')]
+LONG_BRANCH_SIZE = 5
+
+# conditional branch opcode -> (opcode of the inverted branch, its mnemonic)
+INVERTED_BRANCHES = {}
+for _branch, _inverted in [('BPL', 'BMI'), ('BVC', 'BVS'), ('BCC', 'BCS'), ('BNE', 'BEQ')]:
+    INVERTED_BRANCHES[OPCODES[(_branch, 'r')]] = (OPCODES[(_inverted, 'r')], _inverted)
+    INVERTED_BRANCHES[OPCODES[(_inverted, 'r')]] = (OPCODES[(_branch, 'r')], _branch)
+del _branch, _inverted
+
+# Zero page sizing, see optimize_layout. Operands referring to labels
+# start out in the zero page form of their instruction, and go back to
+# the absolute form if their value turns out not to fit.
+ZERO_PAGE_OPCODES = {}   # absolute opcode -> zero page opcode
+for (mnemonic, addrmode), opcode in OPCODES.items():
+    if addrmode in ('a', 'a,x', 'a,y') and (mnemonic, 'zp'+addrmode[1:]) in OPCODES:
+        ZERO_PAGE_OPCODES[opcode] = OPCODES[(mnemonic, 'zp'+addrmode[1:])]
+ABSOLUTE_OPCODES = {zp:a for a,zp in ZERO_PAGE_OPCODES.items()}
+
+class Statements:
+    """Columnar store for the statements of one section.
+
+    Statement i is of kind kinds[i] and sizes[i] bytes long, with opcode
+    opcodes[i] for instructions, operand operands[i], address addresses[i]
+    once laid out, and comes from line lines[i] of files[file_ids[i]].
+    Operands are ints, or Expressions until labels are resolved, for
+    instructions, bytes for .byte data and lists of words for .word data.
+
+    Indexing and iterating give Instruction, LongBranch, ByteData and
+    WordData objects for printing and encoding. They are read-only copies
+    built from the columns, so changes to them are not stored; statements
+    are changed through the columns.
+    """
+    __slots__ = ('kinds', 'opcodes', 'sizes', 'addresses', 'operands',
+                 'lines', 'file_ids', 'files', '_file_index')
+
+    def __init__(self):
+        self.kinds = bytearray()
+        self.opcodes = bytearray()
+        self.sizes = array('H')
+        self.addresses = array('l')
+        self.operands = []
+        self.lines = array('l')
+        self.file_ids = array('H')
+        self.files = []
+        self._file_index = {}
+
+    def _append(self, kind, opcode, size, operand, context):
+        self.kinds.append(kind)
+        self.opcodes.append(opcode)
+        self.sizes.append(size)
+        self.addresses.append(0)
+        self.operands.append(operand)
+        linum, path = context
+        file_id = self._file_index.get(path)
+        if file_id is None:
+            file_id = self._file_index[path] = len(self.files)
+            self.files.append(path)
+        self.lines.append(linum)
+        self.file_ids.append(file_id)
+
+    def append_instruction(self, opcode, operand, context, current_nonlocal_label):
+        if isinstance(operand, Expression):
+            operand = operand.with_local_labels(current_nonlocal_label, context)
+        self._append(STMT_INSTRUCTION, opcode, OPCODE_LENGTH[opcode], operand, context)
+
+    def append_bytes(self, bs, context):
+        self._append(STMT_BYTES, 0, len(bs), bs, context)
+
+    def append_words(self, ws, context):
+        self._append(STMT_WORDS, 0, 2*len(ws), list(ws), context)
+
+    def context(self, i):
+        return (self.lines[i], self.files[self.file_ids[i]])
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        kind = self.kinds[i]
+        if kind == STMT_BYTES:
+            return ByteData(self.operands[i])
+        elif kind == STMT_WORDS:
+            return WordData(list(self.operands[i]))
+        if self.sizes[i] == LONG_BRANCH_SIZE:
+            return LongBranch(self.opcodes[i], self.operands[i], self.context(i))
+        return Instruction(self.opcodes[i], self.operands[i], self.context(i), None)
+
+    def __iter__(self):
+        for i in range(len(self.kinds)):
+            yield self[i]
+
+    def size(self):
+        return sum(self.sizes)
+
+    def layout(self, base_address):
+        """Set the statement addresses starting at base_address, returning the end address."""
+        addresses = array('l', itertools.accumulate(self.sizes, initial=base_address))
+        end = addresses.pop()
+        self.addresses = addresses
+        return end
+
+    def relayout(self, start):
+        """Update the addresses from statement start on, after sizes changed."""
+        tail = array('l', itertools.accumulate(self.sizes[start:], initial=self.addresses[start]))
+        tail.pop()
+        self.addresses[start:] = tail
+
+    def branch_indices(self):
+        """Indices of the short relative branches."""
+        kinds = self.kinds
+        sizes = self.sizes
+        return [i for i, opcode in enumerate(self.opcodes)
+                if OPCODE_ADDRMODE[opcode] == RELATIVE_ADDRMODE and kinds[i] == STMT_INSTRUCTION and sizes[i] == 2]
+
+    def shorten_zero_page(self):
+        """Switch absolute operands referring to labels to zero page, returning their indices."""
+        indices = []
+        kinds = self.kinds
+        opcodes = self.opcodes
+        for i, operand in enumerate(self.operands):
+            if (kinds[i] == STMT_INSTRUCTION and opcodes[i] in ZERO_PAGE_OPCODES
+                    and isinstance(operand, Expression) and not operand.is_constant()):
+                opcodes[i] = ZERO_PAGE_OPCODES[opcodes[i]]
+                self.sizes[i] = 2
+                indices.append(i)
+        return indices
+
+    def fit_zero_page(self, zero_page_indices, label_addresses):
+        """Switch the operands among zero_page_indices that don't fit back to absolute.
+
+        Returns the indices still to check and the index of the first
+        changed operand, or None if none was.
+        """
+        remaining = []
+        first = None
+        for i in zero_page_indices:
+            try:
+                value = self.operands[i].evaluate(label_addresses)
+            except SyntaxError as e:
+                e.set_context(self.context(i))
+                raise e
+
+            if 0 <= value <= 0xff:
+                remaining.append(i)
+                continue
+
+            self.opcodes[i] = ABSOLUTE_OPCODES[self.opcodes[i]]
+            self.sizes[i] = 3
+            if first is None:
+                first = i
+        return remaining, first
+
+    def relax(self, branch_indices, label_addresses):
+        """Rewrite the out of range branches among branch_indices.
+
+        Returns the indices still to check and the index of the first
+        rewritten branch, or None if none was.
+        """
+        remaining = []
+        first = None
+        for i in branch_indices:
+            operand = self.operands[i]
+            try:
+                target = operand.evaluate(label_addresses) if isinstance(operand, Expression) else operand
+            except SyntaxError as e:
+                e.set_context(self.context(i))
+                raise e
+
+            branch_offset = target - (self.addresses[i] + 2)
+            if -128 <= branch_offset <= 127:
+                remaining.append(i)
+                continue
+
+            if self.opcodes[i] == BRA:
+                self.opcodes[i] = JMP_ABSOLUTE
+                self.sizes[i] = OPCODE_LENGTH[JMP_ABSOLUTE]
+            else:
+                self.sizes[i] = LONG_BRANCH_SIZE
+            if first is None:
+                first = i
+        return remaining, first
+
+    def resolve(self, label_addresses):
+        kinds = self.kinds
+        opcodes = self.opcodes
+        operands = self.operands
+        for i, operand in enumerate(operands):
+            kind = kinds[i]
+            if kind == STMT_BYTES:
+                continue
+
+            try:
+                if kind == STMT_WORDS:
+                    operands[i] = [w.evaluate(label_addresses) for w in operand]
+                    continue
+                if isinstance(operand, Expression):
+                    operand = operand.evaluate(label_addresses)
+            except SyntaxError as e:
+                e.set_context(self.context(i))
+                raise e
+
+            if OPCODE_ADDRMODE[opcodes[i]] == RELATIVE_ADDRMODE and self.sizes[i] != LONG_BRANCH_SIZE:
+                # pc is incremented before jump, add size of this instruction
+                branch_offset = operand - (self.addresses[i] + self.sizes[i])
+
+                if branch_offset > 127 or branch_offset < -128:
+                    raise SyntaxError("Out of range branch (branches are limited to -128 to +127)", self.context(i))
+
+                operand = branch_offset % 256 # convert to unsigned
+
+            elif self.sizes[i] == 2 and not 0 <= operand <= 0xff:
+                # zero page and immediate operands, e.g. a label in LDA (ptr),Y
+                raise SyntaxError(f"Out of range operand {operand:#x} (zero page and immediate operands are limited to $00 to $ff)",
+                                  self.context(i))
+
+            operands[i] = operand
+
+    def encode_into(self, buf, offset):
+        """Write the encoded statements into buf at offset, returning the offset after them."""
+        kinds = self.kinds
+        opcodes = self.opcodes
+        sizes = self.sizes
+        for i, operand in enumerate(self.operands):
+            kind = kinds[i]
+            size = sizes[i]
+            if kind == STMT_INSTRUCTION:
+                buf[offset] = opcodes[i]
+                if size == 2:
+                    buf[offset+1] = operand
+                elif size == 3:
+                    buf[offset+1] = operand & 0xff
+                    buf[offset+2] = (operand >> 8) & 0xff
+                elif size == LONG_BRANCH_SIZE:
+                    buf[offset] = INVERTED_BRANCHES[opcodes[i]][0]
+                    buf[offset+1] = 3
+                    buf[offset+2] = JMP_ABSOLUTE
+                    buf[offset+3] = operand & 0xff
+                    buf[offset+4] = (operand >> 8) & 0xff
+            elif kind == STMT_BYTES:
+                buf[offset:offset+size] = operand
+            else:
+                for j, w in enumerate(operand):
+                    buf[offset+2*j] = w & 0xff
+                    buf[offset+2*j+1] = (w >> 8) & 0xff
+            offset += size
+        return offset
 
 
 #====================================================================
 # Simple mathematical expression parser and evaluator
 #====================================================================
 
-calc_grammar = r'''
-    ?start: sum
-
-    ?sum: product
-        | sum "+" product   -> add
-        | sum "-" product   -> sub
-
-    ?product: atom
-        | product "*" atom  -> mul
-        | product "/" atom  -> div
-        | product "|" atom  -> or_
-        | product "&" atom  -> and_
-        | product "<<" atom  -> lshift
-        | product ">>" atom  -> rshift
-
-    ?atom: NUMBER           -> number
-         | "-" atom         -> neg
-         | ">" atom         -> hi_byte
-         | "<" atom         -> lo_byte
-         | "~" atom         -> inv
-         | LABEL            -> label
-         | CHAR             -> char
-         | "(" sum ")"
-
-    CHAR: /'([^\\]|\\.)'/
-    LABEL: NAME | "''' +LOCAL_LABEL_PREFIX + r'''" NAME
-    DIGIT: "0".."9"
-    HEXDIGIT: "a".."f"|"A".."F"|DIGIT
-    BINDIGIT: "0".."1"
-    NUMBER: DIGIT+ | "$" HEXDIGIT+ | "%" BINDIGIT+
-
-    %import common.CNAME -> NAME
-    %import common.WS_INLINE
-
-    %ignore WS_INLINE
-'''
-
-parser  = Lark(calc_grammar, parser='lalr')
-
-@v_args(inline=True)    # Affects the signatures of the methods
-class CalculateTree(Transformer):
-    from operator import add, sub, mul, floordiv as div, neg, lshift, rshift, inv, or_, and_
-
-    def __init__(self, labels):
-        self._labels = labels
-
-    def number(self, v):
-        if v[0] == '$':
-            return int(v[1:],16)
-        elif v[0] == '%':
-            return int(v[1:],2)
-        else:
-            return int(v)
+def parse_expression(expr):
+    import calc
+    return calc.parse_expression(expr)
+
+# The lark parse tree of an expression is turned into a value tree of
+# nested tuples, (kind, operand, ...) with the numbers and chars already
+# converted, so that parsed expressions can be cached and loaded without
+# lark. Expressions are evaluated by closures compiled once from the value
+# tree, with constant subexpressions folded. compile_tree returns a
+# function taking the label table and returning the value.
+
+BINARY_OPERATORS = {
+    'add':    operator.add,
+    'sub':    operator.sub,
+    'mul':    operator.mul,
+    'div':    operator.floordiv,
+    'or_':    operator.or_,
+    'and_':   operator.and_,
+    'lshift': operator.lshift,
+    'rshift': operator.rshift,
+}
+
+UNARY_OPERATORS = {
+    'neg':     operator.neg,
+    'inv':     operator.inv,
+    'hi_byte': lambda v: (v >> 8) & 0xff,
+    'lo_byte': lambda v: v & 0xff,
+}
+
+def number_value(s):
+    if s[0] == '$':
+        return int(s[1:],16)
+    elif s[0] == '%':
+        return int(s[1:],2)
+    else:
+        return int(s)
 
-    def label(self, name):
-        if self._labels is None:
-            return self
-        else:
+def char_value(c):
+    try:
+        unquoted = c[1:-1] # get rid of quotes
+        decoded = unquoted.encode().decode('unicode_escape') # unescape escape sequences, e.g. \n
+    except:
+        raise SyntaxError(f'Invalid char string literal: {c}')
+
+    if len(decoded) != 1:
+        raise SyntaxError(f'Invalid char string literal: {c}')
+
+    return ord(decoded)
+
+def value_tree(node):
+    """Convert a lark parse tree node into a value tree.
+
+    Numbers and chars become ('number', value), labels ('label', name)
+    and operators (operator, operand, ...).
+    """
+    kind = node.data
+    if kind == 'number':
+        return ('number', number_value(node.children[0]))
+    elif kind == 'char':
+        return ('number', char_value(node.children[0]))
+    elif kind == 'label':
+        return ('label', str(node.children[0]))
+    return (kind,) + tuple(value_tree(child) for child in node.children)
+
+def tree_labels(tree):
+    """Names of the labels referenced in a value tree."""
+    if tree[0] == 'label':
+        return {tree[1]}
+    if tree[0] == 'number':
+        return set()
+    return set().union(*(tree_labels(operand) for operand in tree[1:]))
+
+def _compile_node(node):
+    """Compile a value tree node, returning (function, None) or (None, constant value)."""
+    kind = node[0]
+    if kind == 'number':
+        return None, node[1]
+    elif kind == 'label':
+        name = node[1]
+        def label(labels):
             try:
-                return self._labels[name.value]
+                return labels[name]
             except KeyError:
-                raise SyntaxError(f"label {name.value} not defined")
+                raise SyntaxError(f"label {name} not defined")
+        return label, None
+
+    elif kind in UNARY_OPERATORS:
+        op = UNARY_OPERATORS[kind]
+        f, value = _compile_node(node[1])
+        if f is None:
+            return None, op(value)
+        if kind == 'lo_byte':
+            return (lambda labels: f(labels) & 0xff), None
+        elif kind == 'hi_byte':
+            return (lambda labels: (f(labels) >> 8) & 0xff), None
+        return (lambda labels: op(f(labels))), None
+
+    op = BINARY_OPERATORS[kind]
+    f, a = _compile_node(node[1])
+    g, b = _compile_node(node[2])
+    if f is None and g is None:
+        return None, op(a, b)
+    elif g is None:
+        return (lambda labels: op(f(labels), b)), None
+    elif f is None:
+        return (lambda labels: op(a, g(labels))), None
+    return (lambda labels: op(f(labels), g(labels))), None
+
+def compile_tree(tree):
+    """Compile an expression value tree into a function of the label table."""
+    f, value = _compile_node(tree)
+    if f is None:
+        return lambda labels: value
+    return f
 
-    def hi_byte(self, v):
-        return (v >> 8) & 0xff
+def evaluate_expression(expr_tree, labels):
+    return compile_tree(expr_tree)(labels)
 
-    def lo_byte(self, v):
-        return v & 0xff
+class Expression:
+    """A parsed expression, see compile_expression.
 
-    def char(self, c):
-        try:
-            unquoted = c[1:-1] # get rid of quotes
-            decoded = unquoted.encode().decode('unicode_escape') # unescape escape sequences, e.g. \n
-        except:
-            raise SyntaxError(f'Invalid char string literal: {c}')
+    Expressions without label references are folded to their value when
+    created. The others keep their value tree, which is compiled on first
+    evaluation once the label addresses are known. Expressions are shared
+    between all uses of the same text, and must not be modified.
+    """
 
-        if len(decoded) != 1:
-            raise SyntaxError(f'Invalid char string literal: {c}')
+    def __init__(self, text, tree):
+        self.text = text
+        self.tree = tree
+        self.labels = frozenset(tree_labels(tree))
+        self._evaluate = None
 
-        return ord(decoded)
+        if self.labels:
+            self.value = None
+        else:
+            self.value = evaluate_expression(tree, {})
 
+    def __getstate__(self):
+        # the compiled function can't be pickled, it is compiled again when needed
+        state = self.__dict__.copy()
+        state['_evaluate'] = None
+        return state
 
-def parse_expression(expr):
-    return parser.parse(expr)
+    def __str__(self):
+        return self.text
+
+    def is_constant(self):
+        return self.value is not None
+
+    def evaluate(self, labels):
+        if self.value is not None:
+            return self.value
+        if self._evaluate is None:
+            self._evaluate = compile_tree(self.tree)
+        return self._evaluate(labels)
+
+    def with_local_labels(self, nonlocal_label, context=None):
+        """Return this expression with local label references prefixed by nonlocal_label.
+
+        context is the (line, file) given to the SyntaxError raised when
+        there is no non-local label.
+        """
+        local_labels = [l for l in self.labels if l.startswith(LOCAL_LABEL_PREFIX)]
+        if not local_labels:
+            return self
 
-def evaluate_expression(expr_tree, labels):
-    evaluator = CalculateTree(labels)
-    try:
-        return evaluator.transform(expr_tree)
-    except VisitError as e:
-        raise e.orig_exc
+        if nonlocal_label is None:
+            raise SyntaxError(f"Local label '{local_labels[0]}' with no preceeding non-local label", context)
+
+        return _qualified_expression(self, nonlocal_label)
 
-def expression_size(expr_tree):
+@functools.lru_cache(maxsize=1 << 16)
+def compile_expression(text):
+    """Parse an expression, memoized on its text."""
+    return Expression(text, value_tree(parse_expression(text)))
 
-    simplified = evaluate_expression(expr_tree, None)
+def _qualified_tree(tree, nonlocal_label):
+    if tree[0] == 'label':
+        if tree[1].startswith(LOCAL_LABEL_PREFIX):
+            return ('label', nonlocal_label+tree[1])
+        return tree
+    if tree[0] == 'number':
+        return tree
+    return (tree[0],) + tuple(_qualified_tree(operand, nonlocal_label) for operand in tree[1:])
 
-    if isinstance(simplified, int):
-        if simplified > 255:
+@functools.lru_cache(maxsize=1 << 16)
+def _qualified_expression(expr, nonlocal_label):
+    return Expression(expr.text, _qualified_tree(expr.tree, nonlocal_label))
+
+def expression_size(expr):
+
+    if expr.is_constant():
+        if expr.value > 255:
             return 2
         else:
             return 1
-    elif expr_tree.data in ['lo_byte', 'hi_byte']:
+    elif expr.tree[0] in ['lo_byte', 'hi_byte']:
         return 1
     else:
         return 2
@@ -332,6 +681,9 @@ def read_and_prune(file_path):
     with open(file_path,'r') as f:
         src = f.readlines()
 
+    return prune(src, file_path)
+
+def prune(src, file_path):
     src_out = []
     for i,line in enumerate(src):
         idx = line.find(";")
@@ -362,37 +714,89 @@ class PreprocessorError(Exception):
     def get_context(self):
         return self._context
 
+DEFINE_REGEX = re.compile(r'^#define ([a-zA-Z_]\w*)\s+(.*)$')
+IDENTIFIER_REGEX = re.compile(r'\w+')
+
+# names that may refer to variables, not numbers like 10, $ff00 or %1010
+REFERENCE_REGEX = re.compile(r'(?<![$%\w])[a-zA-Z_]\w*')
+
 def replace_variable_references(s, variables):
-    for name in variables:
-        val = variables[name]
-        s = re.sub(r'\b'+name+r'\b', val,  s)
+    """Substitute all variable references in s in a single pass.
+
+    Only whole words are replaced, and substituted values are not expanded
+    again (define_variable keeps them up to date).
+    """
+    if not variables:
+        return s
+
+    get = variables.get
+    return IDENTIFIER_REGEX.sub(lambda m: get(m.group(0), m.group(0)), s)
+
+def has_undefined_references(value, variables):
+    return any(t not in variables for t in REFERENCE_REGEX.findall(value))
+
+def define_variable(name, value, variables, open_names=None):
+    """Add a variable, expanding its value with the variables defined so far.
+
+    Earlier values referring to the new variable are updated as well, the
+    same as if every variable was substituted in order of definition.
+    open_names, if given, is the set of variables whose values have
+    undefined references; only those are checked, and the set is kept up
+    to date.
+    """
+    value = replace_variable_references(value, variables)
+
+    candidates = list(variables if open_names is None else open_names)
+    for other in candidates:
+        other_value = variables[other]
+        if name in other_value:
+            variables[other] = IDENTIFIER_REGEX.sub(lambda m: value if m.group(0) == name else m.group(0), other_value)
+
+    variables[name] = value
+
+    if open_names is not None:
+        open_names.add(name)
+        for other in candidates+[name]:
+            if not has_undefined_references(variables[other], variables):
+                open_names.discard(other)
+
+def include_path(line, context):
+    """Return the path of the file included by an #include line, or None."""
+    m = re.match(r'^#include\s+"(.*)"$', line)
+    if not m:
+        return None
+
+    include_fn = m.group(1)
+    fp = context[1] # file path
+    include_fp = fp.with_name(include_fn)
+    if not include_fp.exists():
+        raise PreprocessorError("Invalid include, can't find file {include_fp}", context)
 
-    return s
+    return include_fp
 
 def preprocess(src_in, variables = None):
     if variables is None:
         variables = {}
+    open_names = {n for n,v in variables.items() if has_undefined_references(v, variables)}
     src_out = []
     for line,context in src_in:
 
-        if m := re.match("^#define ([a-zA-Z_]\w*)\s+(.*)$",line):
+        if line[0] != '#':
+            line = replace_variable_references(line, variables)
+            src_out.append((line,context))
+
+        elif m := DEFINE_REGEX.match(line):
             # variable definition
             name = m.group(1)
             if name in variables:
                 raise PreprocessorError(f"Redefinition of variable '{name}'", context)
 
-            value = m.group(2)
-            variables[name] = replace_variable_references(value, variables)
-        elif m := re.match(r'^#include\s+"(.*)"$', line):
-            include_fn = m.group(1)
-            fp = context[1] # file path
-            include_fp = fp.with_name(include_fn)
-            if not include_fp.exists():
-                raise PreprocessorError("Invalid include, can't find file {include_fp}", context)
-
+            define_variable(name, m.group(2), variables, open_names)
+        elif include_fp := include_path(line, context):
             included_src = read_and_prune(include_fp)
             pp_included_src = preprocess(included_src, variables)
             src_out.extend(pp_included_src)
+            open_names = {n for n,v in variables.items() if has_undefined_references(v, variables)}
 
         else:
             line = replace_variable_references(line, variables)
@@ -407,15 +811,15 @@ def preprocess(src_in, variables = None):
 
 def parse_parameter(param):
 
-    tree = parse_expression(param)
+    expr = compile_expression(param)
 
     # check size of result
-    if expression_size(tree) == 1:
+    if expression_size(expr) == 1:
         param_type = "zp"
     else:
         param_type = "a"
 
-    return param_type, tree
+    return param_type, expr
 
 
 def parse_argument(arg):
@@ -447,7 +851,8 @@ def parse_argument(arg):
     # match stuff like (<expr>),Y
     if m := re.match("^\((.+)\),(Y)$",arg):
         param_type,val = parse_parameter(m.group(1))
-        if param_type != "zp":
+        # labels are checked to be in zero page once resolved
+        if param_type != "zp" and val.is_constant():
             raise SyntaxError("Invalid format of base literal for Zero Page Indirect Indexed operand string:",arg)
         return "(zp),y",val
 
@@ -468,13 +873,19 @@ def parse_argument(arg):
     return param_type,val
 
 
-def parse_instruction(source_line, context, current_nonlocal_label):
+def parse_opcode(source_line):
     mnemonic = source_line.split()[0].upper()
     mnemonic_len = len(mnemonic)
     arg_fmt, param = parse_argument(source_line[mnemonic_len:].strip())
 
     opcode = identify_opcode(mnemonic,arg_fmt)
 
+    return opcode, param
+
+
+def parse_instruction(source_line, context, current_nonlocal_label):
+    opcode, param = parse_opcode(source_line)
+
     return Instruction(opcode, param, context, current_nonlocal_label)
 
 
@@ -506,7 +917,7 @@ def parse_byte(s):
 
 def parse_word(s):
 
-    return parse_expression(s)
+    return compile_expression(s)
 
 
 def parse_string(s):
@@ -525,27 +936,90 @@ def parse_string(s):
 # Assembly functions
 # ===================================================================
 
-def parse_lines(source):
+LABEL_REGEX = re.compile('^('+re.escape(LOCAL_LABEL_PREFIX)+r'?[a-zA-Z_]\w*):(.*)$')
+
+def parse_line(line):
+    """Parse a single preprocessed source line into (label, statement).
+
+    label is None or the label as written (local labels are not yet
+    prefixed with their non-local label). statement is None, or one of
+    ('org', address), ('bytes', bytes), ('words', [expression, ...]) and
+    ('instruction', opcode, operand).
+
+    The result only depends on the line itself, which makes it cacheable.
+    """
+
+    label = None
+    m = LABEL_REGEX.match(line)
+    if m:
+        label = m.group(1)
+        line = m.group(2).strip()
+
+    if not line:
+        # line was empty, i.e. there was nothin after the label
+        return label, None
+
+    # Parse statement
+
+    if line.startswith(".org "):
+        arg = line[4:].strip()
+        expr = compile_expression(arg)
+        statement = ('org', expr.evaluate({}))
+
+    elif line.startswith(".byte "):
+        bytez = [parse_byte(a.strip()) for a in line[5:].split(",")]
+        statement = ('bytes', bytes(bytez))
+
+    elif line.startswith(".word ") or line.startswith(".address "):
+        wstr=line[line.find(' '):]
+        words = []
+        for w in wstr.split(","):
+            words.append(parse_word(w.strip()))
+        statement = ('words', words)
+
+    elif line.startswith(".ascii "):
+        # ascii string
+        statement = ('bytes', parse_string(line[6:].strip()))
+
+    elif line.startswith(".asciiz "):
+        # null-terminated ascii string
+        statement = ('bytes', parse_string(line[7:].strip())+b'\0') # append null byte
+
+    else:
+        statement = ('instruction',)+parse_opcode(line)
+
+    return label, statement
+
+
+def parse_source(source):
+    """Run parse_line over preprocessed source, giving (label, statement, context) tuples."""
+    parsed = []
+    for line,context in source:
+        try:
+            label, statement = parse_line(line)
+        except SyntaxError as e:
+            e.set_context(context)
+            raise e
+        parsed.append((label, statement, context))
+    return parsed
+
+
+def build_sections(parsed):
+    """Turn parsed lines into sections of statements and a label table."""
 
     global_statement_count = 0
     sections = []
-    statements = []
+    statements = Statements()
     base_address = 0;
 
-    label_regex='^('+re.escape(LOCAL_LABEL_PREFIX)+'?[a-zA-Z_]\w*):(.*)$'
-
     labels={}
     current_labels = []
-    src_out = []
     current_nonlocal_label = None
 
-    for line,context in source:
-
-        m = re.match(label_regex,line)
-        if m:
-            lbl = m.group(1)
+    for lbl,statement,context in parsed:
 
-            if re.match(re.escape(LOCAL_LABEL_PREFIX),lbl[0]):
+        if lbl is not None:
+            if lbl.startswith(LOCAL_LABEL_PREFIX):
                 if current_nonlocal_label is None:
                     raise SyntaxError(f"Local label '{lbl}' with no preceeding non-local label", context)
                 lbl = current_nonlocal_label+lbl
@@ -553,75 +1027,45 @@ def parse_lines(source):
                 current_nonlocal_label = lbl
 
             current_labels.append((lbl, context))
-            line = m.group(2).strip()
 
-        if not line:
-            # line was empty, i.e. there was nothin after the label
+        if statement is None:
             continue
 
-        try:
-            # Parse statement
-
-            if line.startswith(".org "):
-                arg = line[4:].strip()
-                expr = parse_expression(arg)
-                org_address = evaluate_expression(expr,{})
-
-                if len(statements) > 0:
-                    # save previous section
-                    sections.append({'base_address':base_address, 'statements':statements})
-
-                base_address = org_address
-                statements = []
-
-                s = None # no "statement"
-
-            elif line.startswith(".byte "):
-                bytez = [parse_byte(a.strip()) for a in line[5:].split(",")]
-                s = ByteData(bytes(bytez))
-
-            elif line.startswith(".word ") or line.startswith(".address "):
-                wstr=line[line.find(' '):]
-                words = []
-                for w in wstr.split(","):
-                    words.append(parse_word(w.strip()))
-                s = WordData(words)
-
-            elif line.startswith(".ascii "):
-                # ascii string
-                bytez = parse_string(line[6:].strip())
-                s = ByteData(bytez)
-            elif line.startswith(".asciiz "):
-                # null-terminated ascii string
-                bytez = parse_string(line[7:].strip())
-                s = ByteData(bytez+b'\0') # append null byte
-            else:
-                s = parse_instruction(line, context, current_nonlocal_label)
+        kind = statement[0]
+        if kind == 'org':
+            if len(statements) > 0:
+                # save previous section
+                sections.append({'base_address':base_address, 'statements':statements})
 
-        except SyntaxError as e:
-            e.set_context(context)
-            raise e
+            base_address = statement[1]
+            statements = Statements()
+
+            continue # no "statement"
 
-        if not s is None:
-            statements.append(s)
+        elif kind == 'bytes':
+            statements.append_bytes(statement[1], context)
+        elif kind == 'words':
+            statements.append_words(statement[1], context)
+        else:
+            statements.append_instruction(statement[1], statement[2], context, current_nonlocal_label)
 
-            if current_labels:
-                for l,lcontext in current_labels:
-                    if l in labels:
-                        label_linum,fp = labels[l]['context']
-                        raise SyntaxError(f"Duplicate label '{l}', first label at {label_linum} in {fp}",lcontext)
+        if current_labels:
+            for l,lcontext in current_labels:
+                if l in labels:
+                    label_linum,fp = labels[l]['context']
+                    raise SyntaxError(f"Duplicate label '{l}', first label at {label_linum} in {fp}",lcontext)
 
-                    labels[l] = {'global_statement_idx':global_statement_count, 'context':lcontext}
-                current_labels = []
+                labels[l] = {'global_statement_idx':global_statement_count, 'context':lcontext}
+            current_labels = []
 
-            global_statement_count += 1
+        global_statement_count += 1
 
     if len(statements) > 0:
         # save last section if non-empty
         sections.append({'base_address':base_address, 'statements':statements})
 
     if current_labels:
-        label_context = source[-1][1]
+        label_context = parsed[-1][2]
         raise SyntaxError("Label at end of file", label_context)
 
     # remove line numbers used for debugging
@@ -630,46 +1074,354 @@ def parse_lines(source):
     return sections, labels
 
 
-def resolve_labels(sections,labels):
+def parse_lines(source):
 
-    addresses = []
+    return build_sections(parse_source(source))
 
-    for section in sections:
-        byte_offset = section['base_address']
 
-        for stmt in section['statements']:
-            addresses.append(byte_offset)
-            stmt.set_address(byte_offset)
-            byte_offset += stmt.size()
+def layout_sections(sections, labels):
+    """Lay out the statements of all sections, returning the label addresses."""
+    addresses = array('l')
 
-    label_addresses = {l:addresses[idx] for l,idx in labels.items()}
+    for section in sections:
+        statements = section['statements']
+        statements.layout(section['base_address'])
+        addresses.extend(statements.addresses)
+
+    return {l:addresses[idx] for l,idx in labels.items()}
+
+
+def optimize_layout(sections, labels, relax=False, zero_page=False):
+    """Grow statements until every operand fits, returning a dict of what changed.
+
+    With relax, relative branches that are out of range are rewritten: a
+    conditional branch becomes the inverted branch over a JMP to the
+    target, and BRA becomes a JMP. With zero_page, absolute operands
+    referring to labels use zero page addressing wherever the value fits.
+
+    Zero page operands start out short, so statements only ever grow and
+    the layout reaches a fixed point after at most one pass per statement
+    that changes, usually just a couple. Each pass checks the statements
+    that are still short against the current layout, and only recomputes
+    addresses from the first changed statement of each section.
+
+    The result holds the number of 'relaxed_branches' and
+    'zero_page_operands', and the 'bytes_saved' and 'cycles_saved' (per
+    execution of each instruction once) by the zero page operands.
+    """
+    stores = [section['statements'] for section in sections]
+    zero_page_indices = [statements.shorten_zero_page() if zero_page else [] for statements in stores]
+    branches = [statements.branch_indices() if relax else [] for statements in stores]
+
+    label_addresses = layout_sections(sections, labels)
+
+    relaxed = 0
+    while True:
+        changed = False
+        for n, statements in enumerate(stores):
+            first = None
+            if zero_page_indices[n]:
+                zero_page_indices[n], first = statements.fit_zero_page(zero_page_indices[n], label_addresses)
+            if branches[n]:
+                remaining, first_branch = statements.relax(branches[n], label_addresses)
+                relaxed += len(branches[n]) - len(remaining)
+                branches[n] = remaining
+                if first is None or (first_branch is not None and first_branch < first):
+                    first = first_branch
+            if first is not None:
+                statements.relayout(first)
+                changed = True
+
+        if not changed:
+            break
+
+        addresses = array('l')
+        for statements in stores:
+            addresses.extend(statements.addresses)
+        label_addresses = {l:addresses[idx] for l,idx in labels.items()}
+
+    cycles_saved = 0
+    for statements, indices in zip(stores, zero_page_indices):
+        for i in indices:
+            zp_opcode = statements.opcodes[i]
+            cycles_saved += CYCLES[ABSOLUTE_OPCODES[zp_opcode]] - CYCLES[zp_opcode]
+    zero_page_operands = sum(len(indices) for indices in zero_page_indices)
+
+    return {
+        'relaxed_branches': relaxed,
+        'zero_page_operands': zero_page_operands,
+        'bytes_saved': zero_page_operands,
+        'cycles_saved': cycles_saved,
+    }
+
+
+def relax_branches(sections, labels):
+    """Rewrite relative branches that are out of range, returning how many were."""
+    return optimize_layout(sections, labels, relax=True)['relaxed_branches']
+
+
+def resolve_labels(sections, labels, relax=False, zero_page=False):
+    """Resolve all operands, first optimizing the layout if relax or zero_page is set.
+
+    Each section gets the addresses of the labels it defines as 'labels'.
+    """
+    if relax or zero_page:
+        optimize_layout(sections, labels, relax, zero_page)
+
+    label_addresses = layout_sections(sections, labels)
 
     for section in sections:
-        for stmt in section['statements']:
-            stmt.resolve_labels(label_addresses)
+        section['statements'].resolve(label_addresses)
+        section['labels'] = {}
+
+    # labels index statements over all sections in order
+    starts = list(itertools.accumulate((len(section['statements']) for section in sections[:-1]), initial=0))
+    for l,idx in labels.items():
+        sections[bisect.bisect_right(starts, idx)-1]['labels'][l] = label_addresses[l]
 
     return sections
 
 
-def assemble(input_path):
-    # prune
-    source_lines = read_and_prune(input_path)
+# ===================================================================
+# Profiling
+#
+# assemble() and the ass script report each phase to an optional profile
+# callback, called as profile(phase, stats) when the phase is done. The
+# stats dict holds the wall time, item counts for the phase, the number
+# of expressions parsed and found in the expression cache, parse cache
+# hits and misses when a ParseCache is used, and the peak traced memory
+# if tracemalloc is tracing.
+# ===================================================================
+
+@contextlib.contextmanager
+def profile_phase(profile, phase, cache=None):
+    """Time the body as phase, yielding the stats dict so counts can be added to it."""
+    stats = {}
+    if profile is None:
+        yield stats
+        return
+
+    expr_info = compile_expression.cache_info()
+    if cache is not None:
+        cache_hits, cache_misses = cache.hits, cache.misses
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+
+    yield stats
+
+    stats['time'] = time.perf_counter() - start
+    if tracing:
+        stats['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    new_expr_info = compile_expression.cache_info()
+    stats['expressions_parsed'] = new_expr_info.misses - expr_info.misses
+    stats['expression_cache_hits'] = new_expr_info.hits - expr_info.hits
+    if cache is not None:
+        stats['cache_hits'] = cache.hits - cache_hits
+        stats['cache_misses'] = cache.misses - cache_misses
+    profile(phase, stats)
+
+
+def assemble(input_path, cache=None, profile=None, defines=None, relax=False, zero_page=False, layout_stats=None):
+    """Assemble the file at input_path into a list of sections.
+
+    defines maps names to values for #define variables that are set
+    before the first line of the file. With relax, out of range branches
+    are rewritten instead of being errors, and with zero_page operands
+    referring to labels use zero page addressing where they fit, see
+    optimize_layout. layout_stats, if given, is a dict updated with what
+    optimize_layout changed.
+    """
+    variables = {}
+    for name, value in (defines or {}).items():
+        define_variable(name, value, variables)
+    if cache is None:
+        # prune
+        with profile_phase(profile, 'prune') as stats:
+            source_lines = read_and_prune(input_path)
+            stats['lines'] = len(source_lines)
+
+        with profile_phase(profile, 'preprocess') as stats:
+            source_lines = preprocess(source_lines, variables)
+            stats['lines'] = len(source_lines)
+
+        with profile_phase(profile, 'parse') as stats:
+            parsed = parse_source(source_lines)
+            # Harvest labels & build statements
+            sections, labels = build_sections(parsed)
+            stats['statements'] = sum(len(section['statements']) for section in sections)
+            stats['labels'] = len(labels)
+    else:
+        with profile_phase(profile, 'parse', cache) as stats:
+            parsed = cache.parse_file(input_path, variables)
+            sections, labels = build_sections(parsed)
+            stats['statements'] = sum(len(section['statements']) for section in sections)
+            stats['labels'] = len(labels)
+
+    with profile_phase(profile, 'resolve') as stats:
+        if relax or zero_page:
+            changes = optimize_layout(sections, labels, relax, zero_page)
+            stats.update(changes)
+            if layout_stats is not None:
+                layout_stats.update(changes)
+        sections = resolve_labels(sections,labels)
+        stats['sections'] = len(sections)
 
-    source_lines = preprocess(source_lines)
+    return sections
 
-    # Harvest labels & parse statements
-    sections, labels = parse_lines(source_lines)
 
-    sections = resolve_labels(sections,labels)
+# ===================================================================
+# Parse cache
+#
+# Stores the pruned, preprocessed and parsed lines of each source file on
+# disk, keyed by the file path and contents, the #define environment the
+# file is included with, and the assembler version. Entries also record
+# the contents of everything the file includes, and are only used if none
+# of those have changed. Entries are JSON, with expressions stored as
+# their text and value tree, so loading one never runs code from the
+# cache directory.
+# ===================================================================
 
-    return sections
+def _source_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def _assembler_version():
+    h = hashlib.sha256()
+    for module_path in [__file__, Path(__file__).with_name('isa6502.py'), Path(__file__).with_name('calc.py')]:
+        h.update(Path(module_path).read_bytes())
+    return h.hexdigest()
+
+def _expression_to_json(expr):
+    return None if expr is None else [expr.text, expr.tree]
+
+def _tree_from_json(tree):
+    if tree[0] in ('number', 'label'):
+        return (tree[0], tree[1])
+    return (tree[0],) + tuple(_tree_from_json(operand) for operand in tree[1:])
+
+def _expression_from_json(data):
+    return None if data is None else Expression(data[0], _tree_from_json(data[1]))
+
+def _statement_to_json(statement):
+    kind = statement[0]
+    if kind == 'bytes':
+        return [kind, statement[1].hex()]
+    elif kind == 'words':
+        return [kind, [_expression_to_json(w) for w in statement[1]]]
+    elif kind == 'instruction':
+        return [kind, statement[1], _expression_to_json(statement[2])]
+    return list(statement)
+
+def _statement_from_json(data):
+    kind = data[0]
+    if kind == 'bytes':
+        return (kind, bytes.fromhex(data[1]))
+    elif kind == 'words':
+        return (kind, [_expression_from_json(w) for w in data[1]])
+    elif kind == 'instruction':
+        return (kind, data[1], _expression_from_json(data[2]))
+    return tuple(data)
+
+def _parsed_to_json(parsed):
+    return [[label, None if statement is None else _statement_to_json(statement), [linum, str(path)]]
+            for label, statement, (linum, path) in parsed]
+
+def _parsed_from_json(data):
+    return [(label, None if statement is None else _statement_from_json(statement), (linum, Path(path)))
+            for label, statement, (linum, path) in data]
+
+class ParseCache:
+    """Parsed source files, cached in a directory, see parse_file."""
+
+    def __init__(self, directory):
+        self._directory = Path(directory)
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._version = _assembler_version()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, path, content, variables):
+        h = hashlib.sha256()
+        h.update(self._version.encode())
+        h.update(str(path).encode()+b'\0')
+        h.update(content+b'\0')
+        h.update(repr(sorted(variables.items())).encode())
+        return h.hexdigest()
+
+    def _load(self, key):
+        try:
+            with open(self._directory / f'{key}.json', 'rb') as f:
+                entry = json.load(f)
+            entry['parsed'] = _parsed_from_json(entry['parsed'])
+            return entry
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            # missing or unreadable, parsed again
+            return None
+
+    def _store(self, key, entry):
+        entry_path = self._directory / f'{key}.json'
+        tmp_path = entry_path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({**entry, 'parsed': _parsed_to_json(entry['parsed'])}, f)
+        os.replace(tmp_path, entry_path)
+
+    def _dependencies_unchanged(self, dependencies):
+        for dep_path, dep_hash in dependencies.items():
+            try:
+                if _source_hash(Path(dep_path).read_bytes()) != dep_hash:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def parse_file(self, file_path, variables=None):
+        """Equivalent to parse_source(preprocess(read_and_prune(file_path), variables))."""
+        if variables is None:
+            variables = {}
+        parsed, _ = self._parse_file(file_path, variables)
+        return parsed
+
+    def _parse_file(self, file_path, variables):
+        content = Path(file_path).read_bytes()
+        key = self._key(file_path, content, variables)
+
+        entry = self._load(key)
+        if entry is not None and self._dependencies_unchanged(entry['dependencies']):
+            self.hits += 1
+            variables.update(entry['variables'])
+            return entry['parsed'], entry['dependencies']
+
+        self.misses += 1
+
+        parsed = []
+        dependencies = {}
+        chunk = []
+        for line,context in prune(io.TextIOWrapper(io.BytesIO(content)).readlines(), file_path):
+            include_fp = include_path(line, context)
+            if include_fp is None:
+                chunk.append((line,context))
+                continue
+
+            parsed.extend(parse_source(preprocess(chunk, variables)))
+            chunk = []
+
+            included, included_dependencies = self._parse_file(include_fp, variables)
+            parsed.extend(included)
+            dependencies[str(include_fp)] = _source_hash(include_fp.read_bytes())
+            dependencies.update(included_dependencies)
+
+        parsed.extend(parse_source(preprocess(chunk, variables)))
+
+        self._store(key, {'parsed':parsed, 'variables':dict(variables), 'dependencies':dependencies})
+        return parsed, dependencies
 
 def encode_program(sections):
     prog_sections = []
     for section in sections:
-        prog_bytes = []
-        for stmt in section['statements']:
-            prog_bytes.extend(stmt.encode())
+        statements = section['statements']
+        prog_bytes = bytearray(statements.size())
+        statements.encode_into(prog_bytes, 0)
 
         prog_sections.append({'bytes':prog_bytes, 'base_address':section['base_address']})
 
@@ -688,36 +1440,389 @@ def encode_program(sections):
     return prog_sections
 
 
-def program_sections_to_binary(prog_sections, binary_start_address, fillbyte=0):
-    binary = []
+def binary_layout(prog_sections, binary_start_address):
+    """Yield (offset in binary, gap before section, section) for each section.
 
+    Sections are laid out in order, with gaps filled up to their address.
+    Sections below binary_start_address, or below the end of the previous
+    section, follow the previous section directly.
+    """
+    offset = 0
     prev_section_end = binary_start_address
     for section in prog_sections:
-        section_start=section['base_address']
-        gap_size = section_start - prev_section_end
+        section_start = section['base_address']
+        gap_size = max(section_start - prev_section_end, 0)
+        offset += gap_size
+        yield offset, gap_size, section
+        offset += len(section['bytes'])
+        prev_section_end = section_start + len(section['bytes'])
 
-        # Fill any gap
-        binary.extend([fillbyte]*gap_size)
 
-        binary.extend(section['bytes'])
-        prev_section_end = section_start + len(section['bytes'])
+def program_sections_to_binary(prog_sections, binary_start_address, fillbyte=0):
+    layout = list(binary_layout(prog_sections, binary_start_address))
+    if not layout:
+        return bytearray()
+
+    last_offset, _, last_section = layout[-1]
+    binary = bytearray([fillbyte]) * (last_offset + len(last_section['bytes']))
+
+    for offset, _, section in layout:
+        binary[offset:offset+len(section['bytes'])] = section['bytes']
+
+    return binary
+
+
+def write_binary(prog_sections, f, binary_start_address, fillbyte=0):
+    """Stream the binary image to the file object f."""
+    fill = bytes([fillbyte])
+    for _, gap_size, section in binary_layout(prog_sections, binary_start_address):
+        if gap_size:
+            f.write(fill * gap_size)
+        f.write(section['bytes'])
+
+
+# ===================================================================
+# Intel HEX
+# ===================================================================
 
-    return bytes(binary)
+HEX_DATA = 0x00
+HEX_EOF = 0x01
+HEX_EXTENDED_SEGMENT_ADDRESS = 0x02
+HEX_START_SEGMENT_ADDRESS = 0x03
+HEX_EXTENDED_LINEAR_ADDRESS = 0x04
+HEX_START_LINEAR_ADDRESS = 0x05
 
+def hex_record(record_type, address, data=b''):
+    """Encode one Intel HEX record, including the trailing newline."""
+    header = bytes((len(data), (address >> 8) & 0xff, address & 0xff, record_type))
+    checksum = -(sum(header) + sum(data)) & 0xff
+    return b':' + (header + data + bytes((checksum,))).hex().upper().encode() + b'\n'
 
-def program_sections_to_hex(prog_sections, hex_start_address):
 
-    ih = intelhex.IntelHex()
+def _hex_runs(prog_sections, hex_start_address):
+    """Yield (address, data) for each contiguous run of bytes, relative to hex_start_address.
 
+    Sections below hex_start_address wrap around the 16-bit address space.
+    """
+    placed = []
     for section in prog_sections:
-        ih.puts(section['base_address']-hex_start_address, bytes(section['bytes']))
+        address = section['base_address'] - hex_start_address
+        if address < 0:
+            address &= 0xffff
+        placed.append((address, section['bytes']))
+    placed.sort(key=lambda p: p[0])
+
+    run_start = None
+    run_end = None
+    run = []
+    for address, data in placed:
+        if run and address == run_end:
+            run.append(data)
+        else:
+            if run:
+                yield run_start, run[0] if len(run) == 1 else b''.join(run)
+            run_start = address
+            run = [data]
+        run_end = address + len(data)
+    if run:
+        yield run_start, run[0] if len(run) == 1 else b''.join(run)
+
+
+def write_hex(prog_sections, f, hex_start_address, record_length=16):
+    """Write the program as Intel HEX to the binary file object f.
+
+    Records hold at most record_length bytes and never cross a 64 KiB
+    boundary. Extended linear address records are only emitted for images
+    reaching beyond 64 KiB.
+    """
+    if not 1 <= record_length <= 255:
+        raise ValueError(f"Invalid hex record length: {record_length}")
+
+    runs = list(_hex_runs(prog_sections, hex_start_address))
+    extended = bool(runs) and runs[-1][0] + len(runs[-1][1]) > 0x10000
+
+    upper = None
+    for address, data in runs:
+        view = memoryview(data)
+        records = []
+        pos = 0
+        while pos < len(view):
+            addr = address + pos
+            if extended and addr >> 16 != upper:
+                upper = addr >> 16
+                records.append(hex_record(HEX_EXTENDED_LINEAR_ADDRESS, 0, upper.to_bytes(2, 'big')))
+            low = addr & 0xffff
+            length = min(record_length, 0x10000 - low, len(view) - pos)
+            records.append(hex_record(HEX_DATA, low, view[pos:pos+length]))
+            pos += length
+        f.write(b''.join(records))
+
+    f.write(hex_record(HEX_EOF, 0))
+
+
+def program_sections_to_hex(prog_sections, hex_start_address, record_length=16):
+    f = io.BytesIO()
+    write_hex(prog_sections, f, hex_start_address, record_length)
+    return f.getvalue()
+
+
+def read_hex(f):
+    """Read Intel HEX from the file object f, returning a sorted list of sections.
+
+    Adjacent data records are merged into one section. Addresses are the
+    ones in the file, extended by any segment or linear address records.
+    """
+    sections = []
+    current = None
+    current_end = None
+    upper = 0
+    for linum, line in enumerate(f):
+        line = line.strip()
+        if not line:
+            continue
+        if isinstance(line, bytes):
+            line = line.decode('ascii')
+        if line[0] != ':':
+            raise RuntimeError(f"Invalid hex record at line {linum+1}: missing start code")
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            raise RuntimeError(f"Invalid hex record at line {linum+1}: not a hex string")
+        if len(record) < 5 or len(record) != record[0] + 5:
+            raise RuntimeError(f"Invalid hex record at line {linum+1}: wrong length")
+        if sum(record) & 0xff:
+            raise RuntimeError(f"Invalid hex record at line {linum+1}: checksum mismatch")
+
+        record_type = record[3]
+        data = record[4:-1]
+        if record_type == HEX_DATA:
+            address = upper + ((record[1] << 8) | record[2])
+            if current is not None and address == current_end:
+                current['bytes'] += data
+            else:
+                current = {'bytes': bytearray(data), 'base_address': address}
+                sections.append(current)
+            current_end = address + len(data)
+        elif record_type == HEX_EOF:
+            break
+        elif record_type == HEX_EXTENDED_SEGMENT_ADDRESS:
+            upper = int.from_bytes(data, 'big') << 4
+        elif record_type == HEX_EXTENDED_LINEAR_ADDRESS:
+            upper = int.from_bytes(data, 'big') << 16
+        elif record_type not in (HEX_START_SEGMENT_ADDRESS, HEX_START_LINEAR_ADDRESS):
+            raise RuntimeError(f"Invalid hex record at line {linum+1}: unknown record type {record_type:02x}")
+
+    sections.sort(key=lambda s: s['base_address'])
+    return sections
 
-    sio = io.StringIO()
-    ih.write_hex_file(sio)
-    contents = sio.getvalue()
-    sio.close()
 
-    return contents.encode()
+# ===================================================================
+# Symbol files
+#
+# A symbol file maps addresses back to the source: the label names, the
+# file and line of every statement and the address range of every
+# section. Every table is a set of columns sorted by address, read
+# straight into arrays and searched with bisect.
+#
+# After a fixed size header with the magic, version and the length of
+# every column, come the columns in the order of SymbolMap.COLUMNS, all
+# little endian, and a table of NUL terminated UTF-8 strings that the
+# label names and file paths are offsets into.
+# ===================================================================
+
+SYMBOLS_MAGIC = b'65C02SYM'
+SYMBOLS_VERSION = 1
+
+class SymbolMap:
+    """Labels, source lines and section ranges of an assembled program, by address.
+
+    Statement i starts at line_addresses[i] and comes from line
+    line_numbers[i] (counting from 1) of file file_names[line_files[i]].
+    Names and file paths are offsets into strings.
+    """
+    COLUMNS = [('section_starts', 'I'), ('section_ends', 'I'),
+               ('label_addresses', 'I'), ('label_names', 'I'),
+               ('line_addresses', 'I'), ('line_files', 'H'), ('line_numbers', 'I'),
+               ('file_names', 'I')]
+
+    def __init__(self):
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.strings = b''
+
+    @classmethod
+    def from_sections(cls, sections):
+        """Build the map of resolved sections (see resolve_labels)."""
+        symbols = cls()
+        strings = bytearray()
+        def add_string(s):
+            offset = len(strings)
+            strings.extend(s.encode() + b'\0')
+            return offset
+
+        file_ids = {}
+        ranges = []
+        labels = []
+        lines = []
+        for section in sections:
+            statements = section['statements']
+            ranges.append((section['base_address'], section['base_address'] + statements.size()))
+            labels.extend((address, name) for name, address in section['labels'].items())
+            for i in range(len(statements)):
+                linum, path = statements.context(i)
+                if path not in file_ids:
+                    file_ids[path] = len(file_ids)
+                    symbols.file_names.append(add_string(str(path)))
+                lines.append((statements.addresses[i], file_ids[path], linum+1))
+
+        for start, end in sorted(ranges):
+            symbols.section_starts.append(start)
+            symbols.section_ends.append(end)
+        for address, name in sorted(labels):
+            symbols.label_addresses.append(address)
+            symbols.label_names.append(add_string(name))
+        for address, file_id, linum in sorted(lines):
+            symbols.line_addresses.append(address)
+            symbols.line_files.append(file_id)
+            symbols.line_numbers.append(linum)
+
+        symbols.strings = bytes(strings)
+        return symbols
+
+    def _string(self, offset):
+        return self.strings[offset:self.strings.index(b'\0', offset)].decode()
+
+    def section_at(self, address):
+        """Return (start, end) of the section holding address, or None."""
+        i = bisect.bisect_right(self.section_starts, address) - 1
+        if i >= 0 and address < self.section_ends[i]:
+            return self.section_starts[i], self.section_ends[i]
+        return None
+
+    def labels_at(self, address):
+        """Return the names of the labels at address."""
+        lo = bisect.bisect_left(self.label_addresses, address)
+        hi = bisect.bisect_right(self.label_addresses, address, lo)
+        return [self._string(self.label_names[i]) for i in range(lo, hi)]
+
+    def labels(self):
+        """Yield (address, name) of all labels, by address."""
+        for address, offset in zip(self.label_addresses, self.label_names):
+            yield address, self._string(offset)
+
+    def line_at(self, address):
+        """Return (path, line) of the statement at or before address in its section, or None."""
+        section = self.section_at(address)
+        i = bisect.bisect_right(self.line_addresses, address) - 1
+        if section is None or i < 0 or self.line_addresses[i] < section[0]:
+            return None
+        return self._string(self.file_names[self.line_files[i]]), self.line_numbers[i]
+
+    def lines(self):
+        """Yield (address, path, line) of all statements, by address."""
+        paths = [self._string(offset) for offset in self.file_names]
+        for address, file_id, linum in zip(self.line_addresses, self.line_files, self.line_numbers):
+            yield address, paths[file_id], linum
+
+
+_SYMBOLS_HEADER = struct.Struct('<8sH' + 'I'*(len(SymbolMap.COLUMNS)+1))
+
+def write_symbols(symbols, f):
+    """Write a SymbolMap to a binary file object."""
+    columns = [getattr(symbols, name) for name, _ in SymbolMap.COLUMNS]
+    f.write(_SYMBOLS_HEADER.pack(SYMBOLS_MAGIC, SYMBOLS_VERSION, *[len(c) for c in columns], len(symbols.strings)))
+    for column in columns:
+        if sys.byteorder == 'big':
+            column = array(column.typecode, column)
+            column.byteswap()
+        f.write(column.tobytes())
+    f.write(symbols.strings)
+
+def read_symbols(f):
+    """Read a SymbolMap written by write_symbols from a binary file object."""
+    header = f.read(_SYMBOLS_HEADER.size)
+    if len(header) != _SYMBOLS_HEADER.size or not header.startswith(SYMBOLS_MAGIC):
+        raise RuntimeError('Not a symbol file')
+    magic, version, *lengths = _SYMBOLS_HEADER.unpack(header)
+    if version != SYMBOLS_VERSION:
+        raise RuntimeError(f'Unsupported symbol file version {version}')
+
+    symbols = SymbolMap()
+    for (name, typecode), length in zip(SymbolMap.COLUMNS, lengths):
+        column = array(typecode)
+        column.frombytes(f.read(length * column.itemsize))
+        if sys.byteorder == 'big':
+            column.byteswap()
+        setattr(symbols, name, column)
+    symbols.strings = f.read(lengths[-1])
+    return symbols
+
+
+# ===================================================================
+# Batch assembly
+#
+# A target is a dict with the 'input' and 'output' paths and optionally
+# 'format', 'base_address' (hex), 'start_address' and 'gap_byte' (bin),
+# 'record_length' (hex), 'defines', 'relax_branches' and 'zero_page',
+# with the same defaults as ass.
+# ===================================================================
+
+TARGET_DEFAULTS = {
+    'format': 'hex',
+    'base_address': 0x8000,
+    'start_address': 0x8000,
+    'gap_byte': 0xff,
+    'record_length': 16,
+    'defines': {},
+    'relax_branches': False,
+    'zero_page': False,
+    }
+
+def build_target(target, cache=None):
+    """Assemble and write one target, returning the number of bytes of code."""
+    target = {**TARGET_DEFAULTS, **target}
+    sections = assemble(target['input'], cache=cache, defines=target['defines'], relax=target['relax_branches'], zero_page=target['zero_page'])
+    prog_sections = encode_program(sections)
+
+    with open(target['output'], 'wb') as f:
+        if target['format'] == 'hex':
+            write_hex(prog_sections, f, target['base_address'], target['record_length'])
+        else:
+            write_binary(prog_sections, f, target['start_address'], fillbyte=target['gap_byte'])
+
+    return sum(len(section['bytes']) for section in prog_sections)
+
+
+# parse cache of each worker process, by directory
+_batch_caches = {}
+
+def _build_target_safely(target, cache_dir):
+    """Run build_target, returning (bytes, None) or (None, error message)."""
+    if cache_dir not in _batch_caches:
+        _batch_caches[cache_dir] = ParseCache(cache_dir)
+    try:
+        return build_target(target, _batch_caches[cache_dir]), None
+    except Exception as e:
+        return None, format_error(e)
+
+
+def build_targets(targets, cache_dir, jobs=1):
+    """Build all targets, sharing the parse cache in cache_dir.
+
+    With jobs > 1 the targets are spread over that many worker processes.
+    Yields (target, bytes, error) in the order of targets, with error None
+    on success and bytes None on failure.
+    """
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = pool.map(_build_target_safely, targets, [cache_dir]*len(targets))
+            for target, (size, error) in zip(targets, results):
+                yield target, size, error
+    else:
+        for target in targets:
+            size, error = _build_target_safely(target, cache_dir)
+            yield target, size, error
 
 
 # ===================================================================
@@ -734,26 +1839,206 @@ def decode_operand(operand_bytes):
 
 def decode_instruction(bytes_in):
     opcode = bytes_in[0]
-    if not opcode in ISA:
+    instr_size = OPCODE_LENGTH[opcode]
+    if instr_size == 0:
         raise Exception(f"Unknown opcode: 0x{opcode:02x}")
-    addrmode = ISA[opcode][1]
-    operand_bytes = bytes_in[1:1+operand_size(addrmode)]
-    operand = decode_operand(operand_bytes)
+    operand = decode_operand(bytes_in[1:instr_size])
     return Instruction(opcode,operand,None,None)
 
+def decode_program(prog):
+    """Walk a program image, yielding (offset, size, opcode, operand).
+
+    Unknown opcodes, and instructions truncated by the end of the image, are
+    yielded as single data bytes with opcode None and the byte as operand.
+    """
+    view = memoryview(prog)
+    bytesize = len(view)
+    lengths = OPCODE_LENGTH
+    bytenum = 0
+    while bytenum < bytesize:
+        opcode = view[bytenum]
+        instr_size = lengths[opcode]
+        if instr_size == 0 or bytenum+instr_size > bytesize:
+            # data byte
+            yield bytenum, 1, None, opcode
+            bytenum += 1
+            continue
+
+        if instr_size == 1:
+            operand = None
+        elif instr_size == 2:
+            operand = view[bytenum+1]
+        else:
+            operand = view[bytenum+1] | (view[bytenum+2] << 8)
+
+        yield bytenum, instr_size, opcode, operand
+        bytenum += instr_size
+
 def disassemble(prog):
+    view = memoryview(prog)
     statements = []
-    bytesize = len(prog)
-    bytenum=0
-    while bytenum < bytesize:
-        try:
-            instr = decode_instruction(prog[bytenum:])
-            instr_size = instr.size()
-            instr_bytes = prog[bytenum:(bytenum+instr_size)]
-            statements.append((bytenum,instr_bytes,instr))
-            bytenum += instr_size
-        except:
+    for bytenum, instr_size, opcode, operand in decode_program(view):
+        instr_bytes = view[bytenum:bytenum+instr_size]
+        if opcode is None:
             # data directive
-            statements.append((bytenum, [prog[bytenum]], None))
-            bytenum += 1
+            statements.append((bytenum, instr_bytes, None))
+        else:
+            statements.append((bytenum, instr_bytes, Instruction(opcode,operand,None,None)))
     return statements
+
+# ===================================================================
+# Control flow tracing
+#
+# Instead of decoding linearly, follow the control flow from the entry
+# points, so bytes that are never reached as code are kept as data.
+# Each byte of the 64K address space is claimed at most once, which
+# keeps tracing linear in the size of the image.
+# ===================================================================
+
+NMI_VECTOR = 0xfffa
+RESET_VECTOR = 0xfffc
+IRQ_VECTOR = 0xfffe
+
+VECTORS = {NMI_VECTOR: 'nmi', RESET_VECTOR: 'reset', IRQ_VECTOR: 'irq'}
+
+# byte kinds in the map returned by trace_code
+UNREACHED = 0
+CODE_START = 1
+CODE_OPERAND = 2
+
+# how a target is reached, from the strongest label kind to the weakest
+TARGET_VECTOR = 0
+TARGET_CALL = 1
+TARGET_JUMP = 2
+TARGET_BRANCH = 3
+
+_JSR = OPCODES[('JSR', 'a')]
+_STOP_OPCODES = {OPCODES[(m, a)] for m, a in [('JMP', 'a'), ('JMP', '(a)'), ('JMP', '(a,x)'), ('BRA', 'r'),
+                                               ('RTS', 'i'), ('RTI', 'i'), ('STP', 'i')]}
+
+def load_memory(prog_sections):
+    """Place program sections in a 64K image, returning (memory, loaded) bytearrays.
+
+    Section addresses wrap around at 64K, and loaded is 1 for every byte
+    any section covers.
+    """
+    memory = bytearray(0x10000)
+    loaded = bytearray(0x10000)
+    for section in prog_sections:
+        data = section['bytes']
+        address = section['base_address'] & 0xffff
+        while data:
+            chunk = data[:0x10000-address]
+            memory[address:address+len(chunk)] = chunk
+            loaded[address:address+len(chunk)] = b'\x01'*len(chunk)
+            data = data[len(chunk):]
+            address = 0
+    return memory, loaded
+
+
+def vector_entry_points(memory, loaded):
+    """{address: name} of the NMI, reset and IRQ handlers, for the vectors that are loaded."""
+    entries = {}
+    for vector, name in VECTORS.items():
+        if loaded[vector] and loaded[vector+1]:
+            entries.setdefault(memory[vector] | (memory[vector+1] << 8), name)
+    return entries
+
+
+def trace_code(memory, loaded, entry_points):
+    """Follow the control flow from entry_points through a 64K image.
+
+    Follows branches, JMP and JSR to absolute addresses, and continues
+    after everything but JMP, BRA, RTS, RTI and STP. A path stops at
+    unknown opcodes, bytes that are not loaded, and instructions that
+    would overlap code traced before.
+
+    Returns (code, targets): code has CODE_START for the first byte of
+    every instruction reached and CODE_OPERAND for the others, and targets
+    maps the addresses jumped and branched to that start an instruction
+    to how they are reached, one of the TARGET_ kinds.
+    """
+    code = bytearray(0x10000)
+    lengths = OPCODE_LENGTH
+    addrmodes = OPCODE_ADDRMODE
+    relative = ADDRMODES.index('r')
+    absolute = ADDRMODES.index('a')
+    targets = {}
+
+    def add_target(address, kind):
+        if kind < targets.get(address, TARGET_BRANCH+1):
+            targets[address] = kind
+        worklist.append(address)
+
+    worklist = []
+    for address in entry_points:
+        add_target(address & 0xffff, TARGET_VECTOR)
+
+    while worklist:
+        address = worklist.pop()
+        while not code[address] and loaded[address]:
+            opcode = memory[address]
+            size = lengths[opcode]
+            if size == 0 or address+size > 0x10000:
+                break
+            end = address+size
+            if any(code[address:end]) or not all(loaded[address:end]):
+                break
+
+            code[address] = CODE_START
+            code[address+1:end] = bytes([CODE_OPERAND])*(size-1)
+
+            addrmode = addrmodes[opcode]
+            if addrmode == relative:
+                offset = memory[address+1]
+                add_target((end + offset - (0x100 if offset > 127 else 0)) & 0xffff, TARGET_BRANCH)
+            elif addrmode == absolute and (opcode == _JSR or opcode == JMP_ABSOLUTE):
+                add_target(memory[address+1] | (memory[address+2] << 8),
+                           TARGET_CALL if opcode == _JSR else TARGET_JUMP)
+
+            if opcode in _STOP_OPCODES:
+                break
+            address = end & 0xffff
+
+    targets = {a:kind for a,kind in targets.items() if code[a] == CODE_START}
+    return code, targets
+
+
+def disassemble_traced(prog_sections, entry_points=None):
+    """Disassemble program sections following the control flow.
+
+    Entry points default to the handlers the vectors at $fffa-$ffff point
+    to, or the start of every section if none of the vectors are loaded.
+    Returns (statements, targets), with statements as from disassemble
+    but at absolute addresses and with every byte not reached as code
+    as data, and targets as from trace_code.
+    """
+    memory, loaded = load_memory(prog_sections)
+    if entry_points is None:
+        entry_points = list(vector_entry_points(memory, loaded))
+        if not entry_points:
+            entry_points = [section['base_address'] & 0xffff for section in prog_sections]
+
+    code, targets = trace_code(memory, loaded, entry_points)
+
+    view = memoryview(memory)
+    statements = []
+    for section in prog_sections:
+        start = section['base_address']
+        address = start
+        end = start + len(section['bytes'])
+        while address < end:
+            a = address & 0xffff
+            if code[a] == CODE_START:
+                size = OPCODE_LENGTH[memory[a]]
+                operand = None
+                if size == 2:
+                    operand = memory[a+1]
+                elif size == 3:
+                    operand = memory[a+1] | (memory[a+2] << 8)
+                statements.append((a, view[a:a+size], Instruction(memory[a], operand, None, None)))
+            else:
+                size = 1
+                statements.append((a, view[a:a+1], None))
+            address += size
+    return statements, targets
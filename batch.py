@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# Shared parts of the batch tools, ass-batch and sim-batch
+#
+# Command line argument types, the inputs and JSON manifests listing what
+# to build or run, and the one line error messages reported per entry.
+#
+
+import glob
+import json
+import argparse
+from pathlib import Path
+
+def auto_int(x):
+    return int(x, 0)
+
+def parse_define(s):
+    name, sep, value = s.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got '{s}'")
+    return name, value
+
+def unescape(s):
+    """Bytes of a string with backslash escapes, as given on the command line."""
+    return s.encode().decode('unicode_escape').encode('latin-1')
+
+def expand_inputs(inputs):
+    """Source files for the positional inputs: files, directories of .s files or glob patterns."""
+    paths = []
+    for pattern in inputs:
+        if Path(pattern).is_dir():
+            paths.extend(sorted(Path(pattern).glob('*.s')))
+        elif glob.has_magic(pattern):
+            paths.extend(Path(p) for p in sorted(glob.glob(pattern)))
+        else:
+            paths.append(Path(pattern))
+    return paths
+
+def read_manifest(manifest_path, key, path_keys=('input',), int_keys=()):
+    """Entries of a JSON manifest, a list of entries or {key: [...]}.
+
+    The paths under path_keys are made relative to the manifest, and
+    numbers under int_keys may be given as strings like "0x8000".
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest[key]
+
+    base_dir = Path(manifest_path).parent
+    entries = []
+    for item in manifest:
+        entry = dict(item)
+        for k in path_keys:
+            if k in entry:
+                entry[k] = base_dir / entry[k]
+        for k in int_keys:
+            if isinstance(entry.get(k), str):
+                entry[k] = int(entry[k], 0)
+        entries.append(entry)
+    return entries
+
+def format_error(e):
+    """One line message for an exception, with the source location if it has one."""
+    # assembly imports this module
+    from assembly import SyntaxError, PreprocessorError
+    context = e.get_context() if isinstance(e, (SyntaxError, PreprocessorError)) else None
+    where = f" at {context[1]}:{context[0]}" if context else ""
+    return f"{type(e).__name__}{where}: {e}"
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+#
+# Assembler throughput on synthetic sources
+#
+# Generates sources of a configurable size and shape, runs them through
+# the phases of assembly.assemble one at a time and reports the best time
+# of each phase. Results can be appended as JSON lines to a file, one
+# record per source size, so runs can be compared over time.
+#
+
+import sys
+import io
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from assembly import (read_and_prune, preprocess, parse_lines, resolve_labels,
+                      encode_program, write_hex, write_binary,
+                      compile_expression, _qualified_expression)
+
+PHASES = ['read_and_prune', 'preprocess', 'parse_lines', 'resolve_labels',
+          'encode_program', 'write_hex', 'write_binary']
+
+# ===================================================================
+# Source generator
+# ===================================================================
+
+class SourceGenerator:
+    """Synthetic source of num_lines code lines, spread over a chain of includes.
+
+    label_density is the fraction of code lines starting a new global
+    label, and with local_labels each global label block also gets local
+    labels with backward branches to them. The #defines are spread over
+    the include files, and expression_complexity is the number of terms in
+    the operand expressions.
+    """
+
+    def __init__(self, num_lines, label_density=0.05, local_labels=True, num_defines=100,
+                 include_depth=2, expression_complexity=3, seed=0):
+        self.num_lines = num_lines
+        self.label_density = label_density
+        self.local_labels = local_labels
+        self.num_defines = max(num_defines, 1)
+        self.include_depth = include_depth
+        self.expression_complexity = max(expression_complexity, 1)
+        self.rng = random.Random(seed)
+        self.num_globals = max(int(num_lines * label_density), 1)
+        self.next_global = 0
+        self.next_local = 0
+
+    def _define(self, i):
+        return f"#define VAR_{i} ${self.rng.randrange(0x100):02x}"
+
+    def _term(self):
+        choice = self.rng.randrange(3)
+        if choice == 0:
+            return f"VAR_{self.rng.randrange(self.num_defines)}"
+        elif choice == 1:
+            return f"${self.rng.randrange(0x100):02x}"
+        return f"({self.rng.randrange(1, 8)}*VAR_{self.rng.randrange(self.num_defines)})"
+
+    def _expression(self, with_label):
+        terms = [self._term() for _ in range(self.expression_complexity - 1)]
+        if with_label:
+            terms.insert(0, f"g_{self.rng.randrange(self.num_globals)}")
+        else:
+            terms.append(self._term())
+        expr = terms[0]
+        for term in terms[1:]:
+            expr += self.rng.choice([' + ', ' - ', ' | ', ' & ']) + term
+        return expr
+
+    def _instruction(self):
+        kind = self.rng.randrange(8)
+        if kind == 0:
+            return f"  LDA #<({self._expression(True)})"
+        elif kind == 1:
+            return f"  LDX #>({self._expression(True)})"
+        elif kind == 2:
+            return f"  STA {self._expression(True)},X"
+        elif kind == 3:
+            return f"  JSR g_{self.rng.randrange(self.num_globals)}"
+        elif kind == 4:
+            return f"  ADC #<({self._expression(False)})"
+        elif kind == 5:
+            return f"  LDY VAR_{self.rng.randrange(self.num_defines)}"
+        elif kind == 6:
+            return "  INX"
+        return "  STA ($10),Y"
+
+    def _code(self, num_lines):
+        lines = []
+        while len(lines) < num_lines:
+            if self.next_global < self.num_globals and self.rng.random() < self.label_density:
+                lines.append(f"g_{self.next_global}:")
+                self.next_global += 1
+                self.next_local = 0
+            if self.local_labels and self.next_global > 0 and self.rng.random() < 0.25:
+                lines.append(f".l_{self.next_local}:")
+                lines.extend(self._instruction() for _ in range(self.rng.randrange(1, 8)))
+                lines.append(f"  BNE .l_{self.next_local}")
+                self.next_local += 1
+            else:
+                lines.append(self._instruction())
+        return lines
+
+    def _remaining_globals(self):
+        # define every label that was referenced but not placed yet
+        lines = []
+        while self.next_global < self.num_globals:
+            lines.append(f"g_{self.next_global}:")
+            lines.append("  RTS")
+            self.next_global += 1
+        return lines
+
+    def write(self, directory):
+        """Write the sources to directory, returning the path of the main file."""
+        directory = Path(directory)
+        num_files = self.include_depth + 1
+        defines = [self._define(i) for i in range(self.num_defines)]
+
+        files = []
+        for level in range(num_files):
+            lines = [f"; synthetic source, include level {level}"]
+            if level == 0:
+                lines.append(".org $8000")
+            lines.extend(defines[level::num_files])
+            if level + 1 < num_files:
+                lines.append(f'#include "level_{level+1}.s"')
+            files.append(lines)
+
+        # defines have to come before their use, so code follows the
+        # includes in the main file and the defines in the included files
+        code_per_file = self.num_lines // num_files
+        for level in reversed(range(num_files)):
+            count = code_per_file if level else self.num_lines - code_per_file*(num_files-1)
+            files[level].extend(self._code(count))
+        files[0].extend(self._remaining_globals())
+
+        for level, lines in enumerate(files):
+            (directory / f"level_{level}.s").write_text('\n'.join(lines) + '\n')
+        return directory / "level_0.s"
+
+
+# ===================================================================
+# Timing
+# ===================================================================
+
+def run_phases(input_path):
+    """Assemble input_path one phase at a time, returning {phase: seconds}."""
+    # start every run with cold expression caches
+    compile_expression.cache_clear()
+    _qualified_expression.cache_clear()
+
+    times = {}
+    def timed(phase, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        times[phase] = time.perf_counter() - start
+        return result
+
+    source_lines = timed('read_and_prune', read_and_prune, input_path)
+    source_lines = timed('preprocess', preprocess, source_lines)
+    sections, labels = timed('parse_lines', parse_lines, source_lines)
+    sections = timed('resolve_labels', resolve_labels, sections, labels)
+    prog_sections = timed('encode_program', encode_program, sections)
+    timed('write_hex', write_hex, prog_sections, io.BytesIO(), 0x8000)
+    timed('write_binary', write_binary, prog_sections, io.BytesIO(), 0x8000, 0xff)
+
+    times['bytes'] = sum(len(s['bytes']) for s in prog_sections)
+    return times
+
+
+def benchmark(generator, repeat):
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = generator.write(tmp)
+        source_lines = sum(1 for p in Path(tmp).iterdir() for _ in p.open())
+        best = None
+        for _ in range(repeat):
+            times = run_phases(input_path)
+            if best is None:
+                best = times
+            else:
+                best = {phase: min(best[phase], times[phase]) for phase in best}
+    best['source_lines'] = source_lines
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the assembler phases on synthetic sources')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='numbers of code lines to generate (10000 and 100000 by default)')
+    parser.add_argument('--label-density', type=float, default=0.05, help='fraction of lines with a global label')
+    parser.add_argument('--no-local-labels', action='store_true', help='do not generate local labels')
+    parser.add_argument('--defines', type=int, default=100, help='number of #defines')
+    parser.add_argument('--include-depth', type=int, default=2, help='depth of the #include chain')
+    parser.add_argument('--expression-complexity', type=int, default=3, help='number of terms in operand expressions')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generator')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions, best time per phase is reported')
+    parser.add_argument('-o', '--output', help='append results as JSON lines to this file')
+    args = parser.parse_args()
+
+    config = {
+        'label_density': args.label_density,
+        'local_labels': not args.no_local_labels,
+        'defines': args.defines,
+        'include_depth': args.include_depth,
+        'expression_complexity': args.expression_complexity,
+        'seed': args.seed,
+    }
+
+    print(f"{'lines':>8}  " + "  ".join(f"{p:>14}" for p in PHASES) + f"  {'total':>10}  {'lines/s':>10}")
+    for size in args.sizes:
+        generator = SourceGenerator(size, label_density=args.label_density,
+                                    local_labels=not args.no_local_labels,
+                                    num_defines=args.defines, include_depth=args.include_depth,
+                                    expression_complexity=args.expression_complexity, seed=args.seed)
+        result = benchmark(generator, args.repeat)
+        total = sum(result[p] for p in PHASES)
+
+        print(f"{size:>8}  " + "  ".join(f"{result[p]*1e3:12.1f}ms" for p in PHASES)
+              + f"  {total:9.2f}s  {result['source_lines']/total:10.0f}")
+
+        if args.output:
+            record = {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'lines': size,
+                'source_lines': result['source_lines'],
+                'bytes': result['bytes'],
+                'config': config,
+                'phases': {p: result[p] for p in PHASES},
+                'total': total,
+            }
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(record) + '\n')
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+#
+# Emulator speed with and without compiled basic blocks
+#
+# Runs programs from progs/ as they assemble, with a VIA where they
+# expect it, for a fixed number of cycles, once per instruction through
+# the handler table and once through compiled blocks, checks that both
+# end in the same state and reports instructions per second. Programs
+# without a .org start at $0000, where code is always interpreted.
+#
+
+import sys
+import time
+import argparse
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from assembly import assemble, encode_program
+from emulator import CPU, Bus, RESET_VECTOR
+from devices import make_via
+
+# name -> address of the VIA
+PROGRAMS = {
+    'erastothenes': 0x6000,
+    'write_numbers': 0x6000,
+    'sleep': 0x6000,
+    'blinky': 0x8000,
+    }
+
+def make_cpu(name, prog_sections, compile_blocks):
+    bus = Bus()
+    bus.attach(make_via(), PROGRAMS[name])
+    cpu = CPU(bus, compile_blocks=compile_blocks)
+    cpu.load(prog_sections)
+    cpu.reset()
+    if not cpu.mem[RESET_VECTOR] | cpu.mem[RESET_VECTOR+1]:
+        # no reset vector, start at the beginning of the code
+        cpu.pc = prog_sections[0]['base_address']
+    return cpu
+
+def state(cpu):
+    return (str(cpu), cpu.instructions, cpu.stopped, bytes(cpu.mem))
+
+def run(name, prog_sections, compile_blocks, max_cycles, repeat):
+    best = None
+    for _ in range(repeat):
+        cpu = make_cpu(name, prog_sections, compile_blocks)
+        start = time.perf_counter()
+        cpu.run(max_cycles=max_cycles)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, cpu
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the emulator with and without compiled blocks')
+    parser.add_argument('programs', nargs='*', default=list(PROGRAMS), help=f'programs to run ({", ".join(PROGRAMS)})')
+    parser.add_argument('-c', '--max-cycles', type=int, default=2000000, help='cycles to run each program for')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions, best time is reported')
+    args = parser.parse_args()
+
+    print(f"{'program':14}  {'address':>7}  {'instructions':>12}  {'interpreted':>12}  {'blocks':>12}  {'speedup':>7}")
+    for name in args.programs:
+        prog_sections = encode_program(assemble(ROOT / 'progs' / f"{name}.s"))
+        t_interpreted, interpreted = run(name, prog_sections, False, args.max_cycles, args.repeat)
+        t_blocks, blocks = run(name, prog_sections, True, args.max_cycles, args.repeat)
+        if state(interpreted) != state(blocks):
+            raise RuntimeError(f"{name}: compiled blocks end in another state than interpretation\n"
+                               f"  {interpreted}\n  {blocks}")
+
+        count = interpreted.instructions
+        address = prog_sections[0]['base_address']
+        print(f"{name:14}  ${address:04x}  {count:12}  {count/t_interpreted:10.0f}/s  {count/t_blocks:10.0f}/s  "
+              f"{t_interpreted/t_blocks:6.2f}x")
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# Preprocessor scaling with the number of #defines
+#
+# Times assembly.preprocess on a fixed number of source lines while the
+# number of defined variables grows, next to the previous approach of
+# running one regex substitution per variable for every line.
+#
+
+import sys
+import re
+import time
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from assembly import preprocess
+
+def regex_per_variable(src_in, variables=None):
+    # the substitution preprocess used to do, without include handling
+    if variables is None:
+        variables = {}
+    src_out = []
+    for line,context in src_in:
+        if m := re.match(r"^#define ([a-zA-Z_]\w*)\s+(.*)$",line):
+            value = m.group(2)
+            for name in variables:
+                value = re.sub(r'\b'+name+r'\b', variables[name], value)
+            variables[m.group(1)] = value
+        else:
+            for name in variables:
+                line = re.sub(r'\b'+name+r'\b', variables[name], line)
+            src_out.append((line,context))
+    return src_out
+
+def make_source(num_defines, num_lines):
+    context = (0, Path('bench.s'))
+    src = [(f"#define VAR_{i} ${i & 0xffff:04x}", context) for i in range(num_defines)]
+    for i in range(num_lines):
+        src.append((f"LDA VAR_{(i*7) % num_defines},X", context))
+    return src
+
+def best_time(fn, src, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(src)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark #define substitution')
+    parser.add_argument('-l', '--lines', type=int, default=2000, help='number of source lines')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='repetitions, best time is reported')
+    parser.add_argument('--max-regex-defines', type=int, default=100,
+                        help='skip the regex-per-variable timing above this many defines')
+    args = parser.parse_args()
+
+    print(f"{'defines':>8}  {'preprocess':>12}  {'regex/var':>12}")
+    for num_defines in [10, 100, 1000, 10000]:
+        src = make_source(num_defines, args.lines)
+        t_new = best_time(preprocess, src, args.repeat)
+        if num_defines <= args.max_regex_defines:
+            t_old = f"{best_time(regex_per_variable, src, args.repeat)*1e3:10.1f}ms"
+        else:
+            t_old = "-"
+        print(f"{num_defines:>8}  {t_new*1e3:10.1f}ms  {t_old:>12}")
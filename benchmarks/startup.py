@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+#
+# Startup time of the command line tools
+#
+# Runs ass, dis and write_bootloader.py as fresh processes on small inputs,
+# where most of the time goes to interpreter startup and imports, next to
+# an empty interpreter as the baseline.
+#
+
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def commands(tmp):
+    binary = Path(tmp) / 'uart.bin'
+    return [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('ass', [sys.executable, str(ROOT / 'ass'), str(ROOT / 'progs' / 'uart.s'), '-o', str(binary)]),
+        ('dis', [sys.executable, str(ROOT / 'dis'), str(binary)]),
+        ('write_bootloader.py', [sys.executable, str(ROOT / 'write_bootloader.py')]),
+        ]
+
+def time_command(cmd, cwd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark startup time of the command line tools')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='runs per command')
+    args = parser.parse_args()
+
+    print(f"{'command':20}  {'best':>8}  {'median':>8}")
+    # write_bootloader.py writes to the current directory
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cmd in commands(tmp):
+            times = time_command(cmd, tmp, args.repeat)
+            print(f"{name:20}  {min(times)*1e3:6.1f}ms  {statistics.median(times)*1e3:6.1f}ms")
@@ -0,0 +1,58 @@
+#!/usr/bin/python3
+#
+# Expression grammar and parser
+#
+# Kept apart from assembly.py so that lark is only imported, and the
+# parser only built, once an expression is actually parsed. Lark caches
+# the LALR tables in the temp directory, so later runs just load them.
+#
+
+import functools
+from lark import Lark
+
+# assembly imports this module on first use, when it is fully loaded
+from assembly import LOCAL_LABEL_PREFIX
+
+calc_grammar = r'''
+    ?start: sum
+
+    ?sum: product
+        | sum "+" product   -> add
+        | sum "-" product   -> sub
+
+    ?product: atom
+        | product "*" atom  -> mul
+        | product "/" atom  -> div
+        | product "|" atom  -> or_
+        | product "&" atom  -> and_
+        | product "<<" atom  -> lshift
+        | product ">>" atom  -> rshift
+
+    ?atom: NUMBER           -> number
+         | "-" atom         -> neg
+         | ">" atom         -> hi_byte
+         | "<" atom         -> lo_byte
+         | "~" atom         -> inv
+         | LABEL            -> label
+         | CHAR             -> char
+         | "(" sum ")"
+
+    CHAR: /'([^\\]|\\.)'/
+    LABEL: NAME | "''' +LOCAL_LABEL_PREFIX + r'''" NAME
+    DIGIT: "0".."9"
+    HEXDIGIT: "a".."f"|"A".."F"|DIGIT
+    BINDIGIT: "0".."1"
+    NUMBER: DIGIT+ | "$" HEXDIGIT+ | "%" BINDIGIT+
+
+    %import common.CNAME -> NAME
+    %import common.WS_INLINE
+
+    %ignore WS_INLINE
+'''
+
+@functools.cache
+def expression_parser():
+    return Lark(calc_grammar, parser='lalr', cache=True)
+
+def parse_expression(expr):
+    return expression_parser().parse(expr)
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+#
+# Cycle counts for assembled code
+#
+# Works on the sections returned by assembly.assemble, once labels are
+# resolved. Static counts use the base cycle counts and page crossing
+# penalties in isa6502. They are for the 65C02; ADC and SBC take one
+# cycle more in decimal mode, which is not known statically and not
+# included. Measured counts come from profiling a run in the emulator.
+#
+
+import bisect
+from isa6502 import ISA, OPCODES, CYCLES, PAGE_PENALTY
+from assembly import STMT_INSTRUCTION, LONG_BRANCH_SIZE, JMP_ABSOLUTE, BRA, u8_to_s8
+
+# instructions after which execution does not continue with the next one
+_BLOCK_ENDS = {OPCODES[(m, a)] for m, a in [('JMP', 'a'), ('JMP', '(a)'), ('JMP', '(a,x)'), ('BRA', 'r'),
+                                              ('RTS', 'i'), ('RTI', 'i'), ('STP', 'i')]}
+
+class Timing:
+    """Cycle count of one instruction.
+
+    cycles is the count when execution continues with the next
+    instruction, that is for a conditional branch when it is not taken,
+    and taken the count when the branch is taken, None for other
+    instructions. Both include crossing a page when branching, which is
+    known from the addresses. page_penalty tells whether indexing may
+    cross a page, for one more cycle. target is the address jumped or
+    branched to, if known.
+    """
+    __slots__ = ('address', 'size', 'opcode', 'cycles', 'taken', 'page_penalty', 'target')
+
+    def __init__(self, address, size, opcode, cycles, taken=None, page_penalty=False, target=None):
+        self.address = address
+        self.size = size
+        self.opcode = opcode
+        self.cycles = cycles
+        self.taken = taken
+        self.page_penalty = page_penalty
+        self.target = target
+
+    def __str__(self):
+        s = str(self.cycles)
+        if self.taken is not None:
+            s += f"/{self.taken}"
+        if self.page_penalty:
+            s += "+p"
+        return s
+
+    def ends_block(self):
+        return self.opcode in _BLOCK_ENDS
+
+
+def _branch_cycles(from_address, target):
+    # taken branches take one cycle more, and another one to another page
+    return 3 if (from_address & 0xff00) == (target & 0xff00) else 4
+
+
+def instruction_timing(statements, i):
+    """Timing of statement i of a Statements store, None for data."""
+    if statements.kinds[i] != STMT_INSTRUCTION:
+        return None
+
+    opcode = statements.opcodes[i]
+    address = statements.addresses[i]
+    size = statements.sizes[i]
+    operand = statements.operands[i]
+    mnemonic, addrmode = ISA[opcode]
+    next_address = address + size
+
+    if size == LONG_BRANCH_SIZE:
+        # inverted branch over a JMP: the inverted branch is taken when the
+        # original condition is false, otherwise it falls through to the JMP
+        return Timing(address, size, opcode, _branch_cycles(address+2, next_address),
+                      taken=2+CYCLES[JMP_ABSOLUTE], target=operand)
+
+    if addrmode == 'r':
+        target = (next_address + u8_to_s8(operand)) & 0xffff
+        if opcode == BRA:
+            return Timing(address, size, opcode, _branch_cycles(next_address, target), target=target)
+        return Timing(address, size, opcode, CYCLES[opcode], taken=_branch_cycles(next_address, target), target=target)
+
+    target = operand if mnemonic in ('JMP', 'JSR') and addrmode == 'a' else None
+
+    page_penalty = False
+    if opcode in PAGE_PENALTY:
+        # an absolute base address at the start of a page can't be crossed
+        # with an 8-bit index, a pointer in zero page always might be
+        page_penalty = addrmode == '(zp),y' or (operand & 0xff) != 0
+
+    return Timing(address, size, opcode, CYCLES[opcode], page_penalty=page_penalty, target=target)
+
+
+def section_timings(section):
+    """Timings of the statements of a section, None for data."""
+    statements = section['statements']
+    return [instruction_timing(statements, i) for i in range(len(statements))]
+
+
+class Loop:
+    """Code from start to the backward branch or jump at branch_address."""
+
+    def __init__(self, start, branch_address, cycles, page_penalties, inner_loops):
+        self.start = start
+        self.branch_address = branch_address
+        self.cycles = cycles
+        self.page_penalties = page_penalties
+        self.inner_loops = inner_loops
+
+
+def find_loops(timings):
+    """Loops closed by backward branches and jumps within the timings of a section.
+
+    The cycles per iteration count the body once as straight line code,
+    with forward branches not taken, and the backward branch taken.
+    Inner loops are counted as a single iteration.
+    """
+    addresses = [t.address if t is not None else None for t in timings]
+    index_of = {a:i for i,a in enumerate(addresses) if a is not None}
+
+    loops = []
+    for end, t in enumerate(timings):
+        if t is None or t.target is None or t.target > t.address or t.target not in index_of:
+            continue
+        if t.taken is None and t.opcode not in (JMP_ABSOLUTE, BRA):
+            # JSR
+            continue
+
+        start = index_of[t.target]
+        body = timings[start:end]
+        if any(b is None for b in body):
+            # data inside, not a loop of this code
+            continue
+
+        cycles = sum(b.cycles for b in body) + (t.taken if t.taken is not None else t.cycles)
+        page_penalties = sum(1 for b in body if b.page_penalty) + t.page_penalty
+        loops.append(Loop(t.target, t.address, cycles, page_penalties, []))
+
+    for loop in loops:
+        loop.inner_loops = [l for l in loops if l is not loop
+                            and loop.start <= l.start and l.branch_address <= loop.branch_address]
+    return loops
+
+
+def label_cycles(timings, labels):
+    """(label, address, cycles, page penalties) for each label of the section.
+
+    Cycles are summed from the label up to the next label or the end of
+    the block, with branches not taken.
+    """
+    index_of = {t.address:i for i,t in enumerate(timings) if t is not None}
+    label_addresses = set(labels.values())
+    result = []
+    for name, address in sorted(labels.items(), key=lambda l: (l[1], l[0])):
+        i = index_of.get(address)
+        if i is None:
+            continue
+        cycles = 0
+        page_penalties = 0
+        for t in timings[i:]:
+            if t is None or (t.address != address and t.address in label_addresses):
+                break
+            cycles += t.cycles
+            page_penalties += t.page_penalty
+            if t.ends_block():
+                break
+        result.append((name, address, cycles, page_penalties))
+    return result
+
+
+def _with_penalties(cycles, page_penalties):
+    if page_penalties:
+        return f"{cycles} (+{page_penalties} on page crossings)"
+    return str(cycles)
+
+
+def _names_at(section):
+    names_at = {}
+    for name, address in section.get('labels', {}).items():
+        names_at.setdefault(address, []).append(name)
+    return names_at
+
+
+def _listing(section, columns):
+    """Yield the lines of a section listed like ass --verbose, with labels and columns(i) after each statement."""
+    statements = section['statements']
+    names_at = _names_at(section)
+
+    rows = []
+    for i in range(len(statements)):
+        stmt = statements[i]
+        address = statements.addresses[i]
+        for name in sorted(names_at.get(address, [])):
+            rows.append((f"{name}:",))
+        bytes_str = " ".join(f"{b:02x}" for b in stmt.encode())
+        rows.append((f"{address:04x}", bytes_str, str(stmt)) + tuple(columns(i)))
+
+    widths = [max(len(r[k]) for r in rows if len(r) > k) for k in range(max(len(r) for r in rows))]
+    for r in rows:
+        if len(r) == 1:
+            yield r[0]
+        else:
+            yield "  ".join([r[0], r[1].ljust(widths[1]), r[2].ljust(widths[2])]
+                            + [c.ljust(w) for c, w in zip(r[3:], widths[3:])]).rstrip()
+
+
+def format_cycles(sections):
+    """Yield the lines of a listing with the cycles of each instruction, per label and per loop."""
+    first_section = True
+    for section in sections:
+        if first_section:
+            first_section = False
+        else:
+            yield '...'
+
+        labels = section.get('labels', {})
+        names_at = _names_at(section)
+        timings = section_timings(section)
+
+        yield from _listing(section, lambda i: [str(timings[i]) if timings[i] is not None else ""])
+
+        blocks = label_cycles(timings, labels)
+        if blocks:
+            yield ""
+            yield "; cycles from label to the next label or end of block, branches not taken"
+            width = max(len(name) for name, *_ in blocks)
+            for name, address, cycles, page_penalties in blocks:
+                yield f"; {name.ljust(width)}  ${address:04x}  {_with_penalties(cycles, page_penalties)}"
+
+        loops = find_loops(timings)
+        if loops:
+            yield ""
+            yield "; loops, cycles per iteration"
+            for loop in loops:
+                names = names_at.get(loop.start, [])
+                name = f" {names[0]}" if names else ""
+                line = f"; ${loop.start:04x}-${loop.branch_address:04x}{name}: {_with_penalties(loop.cycles, loop.page_penalties)}"
+                if loop.inner_loops:
+                    line += f", inner loops counted once: {', '.join(f'${l.start:04x}' for l in loop.inner_loops)}"
+                yield line
+
+
+# ===================================================================
+# Measured cycles
+#
+# Reports on an emulator.Profile taken while running assembled sections:
+# where the instructions and cycles went, by label and by instruction.
+# ===================================================================
+
+def label_profile(profile, sections):
+    """Sum a profile by label, most cycles first.
+
+    Every executed address counts for the closest label at or before it
+    in the same section, or for name None outside of labelled code.
+    Returns a list of (name, address, instructions, cycles).
+    """
+    starts = []
+    for section in sections:
+        end = section['base_address'] + section['statements'].size()
+        for name, address in section.get('labels', {}).items():
+            starts.append((address, name, end))
+    starts.sort()
+    start_addresses = [address for address, _, _ in starts]
+
+    counts = profile.counts
+    cycles = profile.cycles
+    totals = {}
+    for address in (a for a in range(0x10000) if counts[a]):
+        i = bisect.bisect_right(start_addresses, address) - 1
+        key = starts[i][:2] if i >= 0 and address < starts[i][2] else (None, None)
+        total = totals.setdefault(key, [0, 0])
+        total[0] += counts[address]
+        total[1] += cycles[address]
+
+    result = [(name, address, n, c) for (address, name), (n, c) in totals.items()]
+    result.sort(key=lambda r: r[3], reverse=True)
+    return result
+
+
+def format_hot_spots(profile, sections, top=20):
+    """Yield the lines of a table of the top labels by cycles spent."""
+    ranked = label_profile(profile, sections)
+    total = sum(c for _, _, _, c in ranked) or 1
+    width = max([len(name) for name, *_ in ranked[:top] if name is not None] + [len('label')])
+    yield f"{'label':{width}}  {'address':7}  {'instructions':>12}  {'cycles':>12}  {'%':>5}"
+    for name, address, instructions, cycles in ranked[:top]:
+        where = f"${address:04x}" if address is not None else ""
+        yield (f"{name or '(unlabelled)':{width}}  {where:7}  {instructions:12}  {cycles:12}  "
+               f"{100*cycles/total:5.1f}")
+
+
+def format_profile_listing(profile, sections):
+    """Yield the lines of a listing with the instructions executed and cycles taken by each statement."""
+    total = profile.total_cycles() or 1
+    first_section = True
+    for section in sections:
+        if first_section:
+            first_section = False
+        else:
+            yield '...'
+
+        statements = section['statements']
+        def columns(i):
+            address = statements.addresses[i]
+            count = profile.counts[address]
+            if statements.kinds[i] != STMT_INSTRUCTION or not count:
+                return []
+            cycles = profile.cycles[address]
+            return [f"{count:10}", f"{cycles:12}", f"{100*cycles/total:5.1f}%"]
+
+        yield from _listing(section, columns)
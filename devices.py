@@ -0,0 +1,469 @@
+#!/usr/bin/python3
+#
+#
+
+import struct
+from collections import deque
+
+# ===================================================================
+# Memory-mapped device models
+#
+# A device occupies `size` consecutive addresses on the bus, and is
+# accessed through read(offset) and write(offset, value) with the offset
+# relative to the address it is attached at. get_state returns the
+# device state as bytes for snapshots, and set_state(state) puts it back
+# after check_state has checked its size against state_size(state).
+# Serial input that is still pending is not part of the state, so runs
+# continuing from one snapshot can be fed different input.
+# ===================================================================
+
+class Device:
+    size = 1
+
+    def read(self, offset):
+        return 0
+
+    def write(self, offset, value):
+        pass
+
+    def get_state(self):
+        return b''
+
+    def state_size(self, state):
+        """Number of bytes a state returned by get_state has, read from state where it varies."""
+        return 0
+
+    def check_state(self, state):
+        size = self.state_size(state)
+        if len(state) != size:
+            raise RuntimeError(f'Invalid {type(self).__name__} state of {len(state)} bytes, expected {size}')
+
+    def set_state(self, state):
+        self.check_state(state)
+
+
+class SerialPort:
+    """Byte queues for a serial channel: captured output and pending input."""
+
+    def __init__(self):
+        self.output = bytearray()
+        self._input = deque()
+
+    def feed(self, data):
+        self._input.extend(data)
+
+    def has_input(self):
+        return len(self._input) > 0
+
+    def receive(self):
+        if self._input:
+            return self._input.popleft()
+        return 0
+
+    def transmit(self, value):
+        self.output.append(value)
+
+    def output_state(self):
+        return struct.pack('<I', len(self.output)) + self.output
+
+    @staticmethod
+    def output_state_end(state, offset=0):
+        """Offset after the output state at offset in state."""
+        if len(state) < offset + 4:
+            return offset + 4
+        length, = struct.unpack_from('<I', state, offset)
+        return offset + 4 + length
+
+    def set_output_state(self, state, offset=0):
+        """Restore the output from state at offset, returning the offset after it."""
+        length, = struct.unpack_from('<I', state, offset)
+        offset += 4
+        self.output = bytearray(state[offset:offset+length])
+        return offset + length
+
+
+# ===================================================================
+# HD44780 character LCD
+# ===================================================================
+
+class LCD(Device):
+    """HD44780 LCD controller, attached directly to the bus or through a VIA.
+
+    Offset 0 is the instruction/status register, offset 1 the data register.
+    """
+    size = 2
+
+    def __init__(self, columns=16):
+        self.columns = columns
+        self.ddram = bytearray(b' '*0x80)
+        self.address = 0
+        self.increment = True
+        self.display_on = False
+        self.two_lines = False
+
+    _STATE = struct.Struct('<4B128s')
+
+    def get_state(self):
+        return self._STATE.pack(self.address, self.increment, self.display_on, self.two_lines, bytes(self.ddram))
+
+    def state_size(self, state):
+        return self._STATE.size
+
+    def set_state(self, state):
+        self.check_state(state)
+        address, increment, display_on, two_lines, ddram = self._STATE.unpack_from(state)
+        self.address = address
+        self.increment = bool(increment)
+        self.display_on = bool(display_on)
+        self.two_lines = bool(two_lines)
+        self.ddram = bytearray(ddram)
+
+    def _step(self, direction):
+        addr = self.address + direction
+        if self.two_lines:
+            # two line mode uses 0x00-0x27 and 0x40-0x67
+            if addr == 0x28:
+                addr = 0x40
+            elif addr == 0x68:
+                addr = 0x00
+            elif addr == 0x3f:
+                addr = 0x27
+            elif addr == -1:
+                addr = 0x67
+        self.address = addr & 0x7f
+
+    def command(self, value):
+        if value & 0x80:
+            # set DDRAM address
+            self.address = value & 0x7f
+        elif value & 0x40:
+            # set CGRAM address, not modelled
+            pass
+        elif value & 0x20:
+            # function set
+            self.two_lines = bool(value & 0x08)
+        elif value & 0x10:
+            # cursor or display shift, only cursor moves are modelled
+            if not value & 0x08:
+                self._step(1 if value & 0x04 else -1)
+        elif value & 0x08:
+            # display on/off
+            self.display_on = bool(value & 0x04)
+        elif value & 0x04:
+            # entry mode
+            self.increment = bool(value & 0x02)
+        elif value & 0x02:
+            # return home
+            self.address = 0
+        elif value & 0x01:
+            # clear display
+            self.ddram[:] = b' '*0x80
+            self.address = 0
+            self.increment = True
+
+    def status(self):
+        # never busy
+        return self.address
+
+    def write_data(self, value):
+        self.ddram[self.address] = value
+        self._step(1 if self.increment else -1)
+
+    def read_data(self):
+        value = self.ddram[self.address]
+        self._step(1 if self.increment else -1)
+        return value
+
+    def lines(self):
+        first = self.ddram[:self.columns].decode('latin-1')
+        if not self.two_lines:
+            return [first]
+        second = self.ddram[0x40:0x40+self.columns].decode('latin-1')
+        return [first, second]
+
+    def read(self, offset):
+        if offset == 0:
+            return self.status()
+        return self.read_data()
+
+    def write(self, offset, value):
+        if offset == 0:
+            self.command(value)
+        else:
+            self.write_data(value)
+
+
+# ===================================================================
+# 65C22 VIA
+# ===================================================================
+
+# port A control lines to an attached LCD
+VIA_LCD_EN = 0x80
+VIA_LCD_RW = 0x40
+VIA_LCD_RS = 0x20
+
+class VIA(Device):
+    """65C22 VIA, with an optional LCD wired as in progs/hello_world.s.
+
+    Port B carries the LCD data bus and port A bits 7-5 drive E, RW and RS.
+    Timers, shift register and interrupts are not modelled; those registers
+    just hold what was written to them.
+    """
+    size = 16
+
+    def __init__(self, lcd=None):
+        self.lcd = lcd
+        self.regs = bytearray(16)
+        self.port_a_pins = 0
+        self.port_b_pins = 0
+
+    _STATE = struct.Struct('<16sBB')
+
+    def get_state(self):
+        state = self._STATE.pack(bytes(self.regs), self.port_a_pins, self.port_b_pins)
+        if self.lcd is not None:
+            state += self.lcd.get_state()
+        return state
+
+    def state_size(self, state):
+        if self.lcd is None:
+            return self._STATE.size
+        return self._STATE.size + self.lcd.state_size(state[self._STATE.size:])
+
+    def set_state(self, state):
+        self.check_state(state)
+        regs, self.port_a_pins, self.port_b_pins = self._STATE.unpack_from(state)
+        self.regs = bytearray(regs)
+        if self.lcd is not None:
+            self.lcd.set_state(state[self._STATE.size:])
+
+    def _port(self, output, ddr, pins):
+        return (output & ddr) | (pins & ~ddr & 0xff)
+
+    def _update_lcd(self, old_control):
+        control = self._port(self.regs[1], self.regs[3], self.port_a_pins)
+        rs = control & VIA_LCD_RS
+        if control & VIA_LCD_RW:
+            if control & VIA_LCD_EN:
+                # read cycle, data is driven onto port B while E is high
+                self.port_b_pins = self.lcd.read_data() if rs else self.lcd.status()
+        elif old_control & VIA_LCD_EN and not control & VIA_LCD_EN and not old_control & VIA_LCD_RW:
+            # write cycle, data is latched on the falling edge of E
+            rs = old_control & VIA_LCD_RS
+            data = self._port(self.regs[0], self.regs[2], self.port_b_pins)
+            if rs:
+                self.lcd.write_data(data)
+            else:
+                self.lcd.command(data)
+
+    def read(self, offset):
+        if offset == 0:
+            return self._port(self.regs[0], self.regs[2], self.port_b_pins)
+        elif offset == 1:
+            return self._port(self.regs[1], self.regs[3], self.port_a_pins)
+        return self.regs[offset]
+
+    def write(self, offset, value):
+        old_control = self._port(self.regs[1], self.regs[3], self.port_a_pins)
+        self.regs[offset] = value
+        if self.lcd is not None and offset in (1, 3):
+            self._update_lcd(old_control)
+
+
+# ===================================================================
+# Serial devices
+# ===================================================================
+
+class ACIA(Device, SerialPort):
+    """65C51 ACIA. Transmission completes instantly."""
+    size = 4
+
+    ACIA_STATUS_RDRF = 0x08
+    ACIA_STATUS_TDRE = 0x10
+
+    def __init__(self):
+        SerialPort.__init__(self)
+        self.command_reg = 0
+        self.control_reg = 0
+
+    def get_state(self):
+        return bytes([self.command_reg, self.control_reg]) + self.output_state()
+
+    def state_size(self, state):
+        return self.output_state_end(state, 2)
+
+    def set_state(self, state):
+        self.check_state(state)
+        self.command_reg, self.control_reg = state[0], state[1]
+        self.set_output_state(state, 2)
+
+    def read(self, offset):
+        if offset == 0:
+            return self.receive()
+        elif offset == 1:
+            status = self.ACIA_STATUS_TDRE
+            if self.has_input():
+                status |= self.ACIA_STATUS_RDRF
+            return status
+        elif offset == 2:
+            return self.command_reg
+        return self.control_reg
+
+    def write(self, offset, value):
+        if offset == 0:
+            self.transmit(value)
+        elif offset == 1:
+            # programmed reset
+            self.command_reg &= 0xe0
+        elif offset == 2:
+            self.command_reg = value
+        else:
+            self.control_reg = value
+
+
+class UART(Device, SerialPort):
+    """Simple UART with status, receive and transmit registers (progs/uart.s)."""
+    size = 3
+
+    UART_STATUS_TXFULL = 0x01
+    UART_STATUS_RXEMPTY = 0x02
+
+    def __init__(self):
+        SerialPort.__init__(self)
+
+    def get_state(self):
+        return self.output_state()
+
+    def state_size(self, state):
+        return self.output_state_end(state)
+
+    def set_state(self, state):
+        self.check_state(state)
+        self.set_output_state(state)
+
+    def read(self, offset):
+        if offset == 0:
+            return 0 if self.has_input() else self.UART_STATUS_RXEMPTY
+        elif offset == 1:
+            return self.receive()
+        return 0
+
+    def write(self, offset, value):
+        if offset == 2:
+            self.transmit(value)
+
+
+class DUART(Device):
+    """SC28L92 DUART. Transmission completes instantly on both channels.
+
+    Mode registers, clock selection, counters and interrupt masks just hold
+    what was written to them. Channel A is also available as `output` and
+    `feed`, like the single channel devices.
+    """
+    size = 16
+
+    DUART_STATUS_RXREADY = 0x01
+    DUART_STATUS_TXREADY = 0x04
+    DUART_STATUS_TXEMPTY = 0x08
+
+    def __init__(self):
+        self.channels = [SerialPort(), SerialPort()]
+        self.mode_regs = [bytearray(3), bytearray(3)]
+        self.mode_ptr = [0, 0]
+        self.regs = bytearray(16)
+
+    _STATE = struct.Struct('<16s3s3sBB')
+
+    def get_state(self):
+        state = self._STATE.pack(bytes(self.regs), bytes(self.mode_regs[0]), bytes(self.mode_regs[1]), *self.mode_ptr)
+        return state + b''.join(channel.output_state() for channel in self.channels)
+
+    def state_size(self, state):
+        offset = self._STATE.size
+        for _ in self.channels:
+            offset = SerialPort.output_state_end(state, offset)
+        return offset
+
+    def set_state(self, state):
+        self.check_state(state)
+        regs, mode_a, mode_b, ptr_a, ptr_b = self._STATE.unpack_from(state)
+        self.regs = bytearray(regs)
+        self.mode_regs = [bytearray(mode_a), bytearray(mode_b)]
+        self.mode_ptr = [ptr_a, ptr_b]
+        offset = self._STATE.size
+        for channel in self.channels:
+            offset = channel.set_output_state(state, offset)
+
+    @property
+    def output(self):
+        return self.channels[0].output
+
+    def feed(self, data, channel=0):
+        self.channels[channel].feed(data)
+
+    def _status(self, channel):
+        status = self.DUART_STATUS_TXREADY | self.DUART_STATUS_TXEMPTY
+        if self.channels[channel].has_input():
+            status |= self.DUART_STATUS_RXREADY
+        return status
+
+    def _command(self, channel, value):
+        cmd = (value >> 4) & 0x0f
+        if cmd == 0x01:
+            # reset MR pointer to MR1
+            self.mode_ptr[channel] = 1
+        elif cmd == 0x0b:
+            # reset MR pointer to MR0
+            self.mode_ptr[channel] = 0
+
+    # offsets 0-3 and 8-b are the channel A and B registers, the
+    # remaining ones are shared between the channels
+    def read(self, offset):
+        channel, reg = offset >> 3, offset & 0x07
+        if reg == 0:
+            ptr = self.mode_ptr[channel]
+            self.mode_ptr[channel] = min(ptr+1, 2)
+            return self.mode_regs[channel][ptr]
+        elif reg == 1:
+            return self._status(channel)
+        elif reg == 3:
+            return self.channels[channel].receive()
+        return self.regs[offset]
+
+    def write(self, offset, value):
+        channel, reg = offset >> 3, offset & 0x07
+        if reg == 0:
+            ptr = self.mode_ptr[channel]
+            self.mode_regs[channel][ptr] = value
+            self.mode_ptr[channel] = min(ptr+1, 2)
+        elif reg == 2:
+            self._command(channel, value)
+        elif reg == 3:
+            self.channels[channel].transmit(value)
+        else:
+            self.regs[offset] = value
+
+
+# ===================================================================
+# Device catalogue used by the sim script
+# ===================================================================
+
+def make_via():
+    return VIA(lcd=LCD())
+
+DEVICE_TYPES = {
+    'via':   (make_via, 0x8000),
+    'acia':  (ACIA,     0x8100),
+    'lcd':   (LCD,      0x8200),
+    'uart':  (UART,     0x8400),
+    'duart': (DUART,    0x8700),
+    }
+
+def make_device(spec):
+    """Create a device from a 'name' or 'name@address' spec, returning (device, address)."""
+    name, _, addr = spec.partition('@')
+    if name not in DEVICE_TYPES:
+        raise RuntimeError(f"Unknown device '{name}', choose from {', '.join(DEVICE_TYPES)}")
+    factory, default_address = DEVICE_TYPES[name]
+    address = int(addr, 0) if addr else default_address
+    return factory(), address
@@ -0,0 +1,1036 @@
+#!/usr/bin/python3
+#
+#
+
+import time
+import zlib
+import struct
+from array import array
+from isa6502 import ISA, CYCLES, PAGE_PENALTY, OPCODE_LENGTH
+from devices import make_device, LCD, VIA
+from batch import format_error
+
+RESET_VECTOR = 0xfffc
+IRQ_VECTOR = 0xfffe
+NMI_VECTOR = 0xfffa
+
+# ===================================================================
+# Instruction handlers
+#
+# Every opcode in ISA gets its own Python function, generated from the
+# snippets below and compiled once at import. A handler executes a single
+# instruction on a CPU and returns the number of cycles it took.
+#
+# Inside a handler, `mem` is the flat 64 KiB memory image of the Bus, used
+# directly for opcode and operand fetches, zero page and stack accesses.
+# Other data accesses check the bus page tables inline, and only call the
+# bus' read/write (`io_read`/`io_write`) for pages with I/O devices or ROM.
+# ===================================================================
+
+# addressing mode -> (statements computing addr, page crossing expression)
+_ADDRESS_SNIPPETS = {
+    "zp":     (["addr = mem[pc+1]"], None),
+    "zp,x":   (["addr = (mem[pc+1] + cpu.x) & 0xff"], None),
+    "zp,y":   (["addr = (mem[pc+1] + cpu.y) & 0xff"], None),
+    "(zp)":   (["zp = mem[pc+1]",
+                "addr = mem[zp] | mem[(zp+1) & 0xff] << 8"], None),
+    "(zp,x)": (["zp = (mem[pc+1] + cpu.x) & 0xff",
+                "addr = mem[zp] | mem[(zp+1) & 0xff] << 8"], None),
+    "(zp),y": (["zp = mem[pc+1]",
+                "base = mem[zp] | mem[(zp+1) & 0xff] << 8",
+                "addr = (base + cpu.y) & 0xffff"], "((base ^ addr) > 0xff)"),
+    "a":      (["addr = mem[pc+1] | mem[pc+2] << 8"], None),
+    "a,x":    (["base = mem[pc+1] | mem[pc+2] << 8",
+                "addr = (base + cpu.x) & 0xffff"], "((base ^ addr) > 0xff)"),
+    "a,y":    (["base = mem[pc+1] | mem[pc+2] << 8",
+                "addr = (base + cpu.y) & 0xffff"], "((base ^ addr) > 0xff)"),
+    }
+
+_ZERO_PAGE_MODES = ["zp", "zp,x", "zp,y"]
+
+_BRANCH_CONDITIONS = {
+    "BEQ":"cpu.z", "BNE":"not cpu.z",
+    "BCS":"cpu.c", "BCC":"not cpu.c",
+    "BMI":"cpu.n", "BPL":"not cpu.n",
+    "BVS":"cpu.v", "BVC":"not cpu.v",
+    }
+
+_REGISTERS = {"A":"a", "X":"x", "Y":"y"}
+
+def _load(addrmode):
+    if addrmode == "#":
+        return "mem[pc+1]"
+    elif addrmode == "A":
+        return "cpu.a"
+    elif addrmode in _ZERO_PAGE_MODES:
+        return "mem[addr]"
+    else:
+        return _read("addr")
+
+def _read(addr):
+    return f"(io_read({addr}) if io_pages[{addr} >> 8] else mem[{addr}])"
+
+def _store(addrmode, value):
+    if addrmode == "A":
+        return [f"cpu.a = {value}"]
+    elif addrmode in _ZERO_PAGE_MODES:
+        return [f"mem[addr] = {value}"]
+    else:
+        return ["if write_pages[addr >> 8]:",
+                f"    io_write(addr, {value})",
+                "else:",
+                f"    mem[addr] = {value}"]
+
+def _set_nz(var):
+    return [f"cpu.z = {var} == 0", f"cpu.n = {var} >> 7"]
+
+def _push(value):
+    return ["sp = cpu.sp",
+            f"mem[0x100 | sp] = {value}",
+            "cpu.sp = (sp - 1) & 0xff"]
+
+def _pull(var):
+    return ["sp = (cpu.sp + 1) & 0xff",
+            "cpu.sp = sp",
+            f"{var} = mem[0x100 | sp]"]
+
+_ADC_BINARY = [
+    "a = cpu.a",
+    "r = a + v + cpu.c",
+    "cpu.c = r >> 8",
+    "r &= 0xff",
+    "cpu.v = ((a ^ r) & (v ^ r)) >> 7",
+    "cpu.a = r",
+    ] + _set_nz("r")
+
+_RMW_OPERATIONS = {
+    "INC":["r = (v + 1) & 0xff"],
+    "DEC":["r = (v - 1) & 0xff"],
+    "ASL":["r = (v << 1) & 0xff", "cpu.c = v >> 7"],
+    "LSR":["r = v >> 1", "cpu.c = v & 1"],
+    "ROL":["r = ((v << 1) | cpu.c) & 0xff", "cpu.c = v >> 7"],
+    "ROR":["r = (v >> 1) | (cpu.c << 7)", "cpu.c = v & 1"],
+    }
+
+def _operation(mnemonic, addrmode):
+    """Return (statements, sets_pc, extra cycle expressions) for an instruction."""
+
+    if mnemonic in ["LDA", "LDX", "LDY"]:
+        reg = _REGISTERS[mnemonic[2]]
+        return [f"v = {_load(addrmode)}", f"cpu.{reg} = v"] + _set_nz("v"), False, []
+
+    elif mnemonic in ["STA", "STX", "STY"]:
+        reg = _REGISTERS[mnemonic[2]]
+        return _store(addrmode, f"cpu.{reg}"), False, []
+
+    elif mnemonic == "STZ":
+        return _store(addrmode, "0"), False, []
+
+    elif mnemonic in ["AND", "ORA", "EOR"]:
+        op = {"AND":"&", "ORA":"|", "EOR":"^"}[mnemonic]
+        return [f"v = cpu.a {op} {_load(addrmode)}", "cpu.a = v"] + _set_nz("v"), False, []
+
+    elif mnemonic == "ADC":
+        stmts = [f"v = {_load(addrmode)}",
+                 "if cpu.d:",
+                 "    adc_decimal(cpu, v)",
+                 "else:"] + ["    "+s for s in _ADC_BINARY]
+        return stmts, False, ["cpu.d"]
+
+    elif mnemonic == "SBC":
+        stmts = [f"v = {_load(addrmode)}",
+                 "if cpu.d:",
+                 "    sbc_decimal(cpu, v)",
+                 "else:",
+                 "    v ^= 0xff"] + ["    "+s for s in _ADC_BINARY]
+        return stmts, False, ["cpu.d"]
+
+    elif mnemonic in ["CMP", "CPX", "CPY"]:
+        reg = {"CMP":"a", "CPX":"x", "CPY":"y"}[mnemonic]
+        return [f"r = cpu.{reg} - {_load(addrmode)}",
+                "cpu.c = r >= 0",
+                "r &= 0xff"] + _set_nz("r"), False, []
+
+    elif mnemonic == "BIT":
+        stmts = [f"v = {_load(addrmode)}", "cpu.z = (cpu.a & v) == 0"]
+        if addrmode != "#":
+            # immediate BIT only affects Z
+            stmts += ["cpu.n = v >> 7", "cpu.v = (v >> 6) & 1"]
+        return stmts, False, []
+
+    elif mnemonic in _RMW_OPERATIONS:
+        return ([f"v = {_load(addrmode)}"] + _RMW_OPERATIONS[mnemonic]
+                + _store(addrmode, "r") + _set_nz("r")), False, []
+
+    elif mnemonic == "TSB":
+        return [f"v = {_load(addrmode)}",
+                "cpu.z = (cpu.a & v) == 0"] + _store(addrmode, "v | cpu.a"), False, []
+
+    elif mnemonic in ["INX", "DEX", "DEY"]:
+        reg = mnemonic[2].lower()
+        delta = "+ 1" if mnemonic[0] == "I" else "- 1"
+        return [f"r = (cpu.{reg} {delta}) & 0xff", f"cpu.{reg} = r"] + _set_nz("r"), False, []
+
+    elif mnemonic in ["TAX", "TAY", "TXA", "TYA", "TSX", "TXS"]:
+        src = {"A":"a", "X":"x", "Y":"y", "S":"sp"}[mnemonic[1]]
+        dst = {"A":"a", "X":"x", "Y":"y", "S":"sp"}[mnemonic[2]]
+        stmts = [f"r = cpu.{src}", f"cpu.{dst} = r"]
+        if mnemonic != "TXS":
+            stmts += _set_nz("r")
+        return stmts, False, []
+
+    elif mnemonic in ["CLC", "CLD", "CLI", "CLV", "SEC", "SED", "SEI"]:
+        flag = mnemonic[2].lower()
+        value = 1 if mnemonic[0] == "S" else 0
+        return [f"cpu.{flag} = {value}"], False, []
+
+    elif mnemonic in ["PHA", "PHX", "PHY"]:
+        return _push(f"cpu.{mnemonic[2].lower()}"), False, []
+
+    elif mnemonic == "PHP":
+        return _push("cpu.get_status() | 0x10"), False, []
+
+    elif mnemonic in ["PLA", "PLX", "PLY"]:
+        reg = mnemonic[2].lower()
+        return _pull("r") + [f"cpu.{reg} = r"] + _set_nz("r"), False, []
+
+    elif mnemonic == "PLP":
+        return _pull("r") + ["cpu.set_status(r)"], False, []
+
+    elif mnemonic == "JSR":
+        return ["ret = pc + 2",
+                "sp = cpu.sp",
+                "mem[0x100 | sp] = ret >> 8",
+                "mem[0x100 | (sp - 1) & 0xff] = ret & 0xff",
+                "cpu.sp = (sp - 2) & 0xff",
+                "cpu.pc = addr"], True, []
+
+    elif mnemonic == "RTS":
+        return ["sp = cpu.sp",
+                "lo = mem[0x100 | (sp + 1) & 0xff]",
+                "hi = mem[0x100 | (sp + 2) & 0xff]",
+                "cpu.sp = (sp + 2) & 0xff",
+                "cpu.pc = ((hi << 8 | lo) + 1) & 0xffff"], True, []
+
+    elif mnemonic == "RTI":
+        return ["sp = cpu.sp",
+                "cpu.set_status(mem[0x100 | (sp + 1) & 0xff])",
+                "lo = mem[0x100 | (sp + 2) & 0xff]",
+                "hi = mem[0x100 | (sp + 3) & 0xff]",
+                "cpu.sp = (sp + 3) & 0xff",
+                "cpu.pc = hi << 8 | lo"], True, []
+
+    elif mnemonic == "JMP":
+        if addrmode == "a":
+            return ["cpu.pc = addr"], True, []
+        elif addrmode == "(a)":
+            ptr = "mem[pc+1] | mem[pc+2] << 8"
+        else:
+            ptr = "((mem[pc+1] | mem[pc+2] << 8) + cpu.x) & 0xffff"
+        return [f"ptr = {ptr}",
+                "ptr_hi = (ptr + 1) & 0xffff",
+                f"cpu.pc = {_read('ptr')} | {_read('ptr_hi')} << 8"], True, []
+
+    elif mnemonic == "STP":
+        return ["cpu.stopped = True", "cpu.attention = True"], False, []
+
+    elif mnemonic in ["NOP", "INV/XCE"]:
+        return [], False, []
+
+    else:
+        raise RuntimeError(f"No emulation for instruction {mnemonic} {addrmode}")
+
+
+def _branch_source(name, opcode, mnemonic):
+    # taken branches cost one extra cycle, plus one if the target is on another page
+    base_cycles = CYCLES[opcode]
+    taken = ["off = mem[pc+1]",
+             "nxt = pc + 2",
+             "target = (nxt + off - ((off & 0x80) << 1)) & 0xffff",
+             "cpu.pc = target"]
+
+    if mnemonic == "BRA":
+        # BRA base cycle count already includes the taken branch
+        body = taken + [f"return {base_cycles} + ((nxt ^ target) > 0xff)"]
+    else:
+        body = ([f"if {_BRANCH_CONDITIONS[mnemonic]}:"]
+                + ["    "+s for s in taken]
+                + [f"    return {base_cycles+1} + ((nxt ^ target) > 0xff)",
+                   "cpu.pc = pc + 2",
+                   f"return {base_cycles}"])
+
+    return [f"def {name}(cpu):", "    pc = cpu.pc"] + ["    "+s for s in body]
+
+
+def _instruction_source(opcode):
+    """Return (statements, sets_pc, extra cycle expressions) for an instruction at pc, not a branch."""
+    mnemonic, addrmode = ISA[opcode]
+    stmts, sets_pc, extra_cycles = _operation(mnemonic, addrmode)
+
+    if addrmode in _ADDRESS_SNIPPETS:
+        address_stmts, page_cross = _ADDRESS_SNIPPETS[addrmode]
+        stmts = address_stmts + stmts
+        if opcode in PAGE_PENALTY:
+            extra_cycles = extra_cycles + [page_cross]
+
+    return stmts, sets_pc, extra_cycles
+
+
+def handler_source(opcode):
+    """Return the Python source of the handler function for an opcode."""
+    mnemonic, addrmode = ISA[opcode]
+    name = f"op_{opcode:02x}"
+
+    if addrmode == "r":
+        return "\n".join(_branch_source(name, opcode, mnemonic))
+
+    stmts, sets_pc, extra_cycles = _instruction_source(opcode)
+
+    if not sets_pc:
+        stmts.append(f"cpu.pc = (pc + {OPCODE_LENGTH[opcode]}) & 0xffff")
+
+    stmts.append("return " + " + ".join([str(CYCLES[opcode])] + extra_cycles))
+
+    return "\n".join([f"def {name}(cpu):", "    pc = cpu.pc"] + ["    "+s for s in stmts])
+
+
+_HANDLER_CODE = compile("\n\n".join(handler_source(opcode) for opcode in sorted(ISA)),
+                        "<emulator handlers>", "exec")
+
+
+def adc_decimal(cpu, v):
+    a = cpu.a
+    lo = (a & 0x0f) + (v & 0x0f) + cpu.c
+    if lo >= 0x0a:
+        lo = ((lo + 0x06) & 0x0f) + 0x10
+    r = (a & 0xf0) + (v & 0xf0) + lo
+    cpu.v = ((a ^ r) & (v ^ r) & 0x80) >> 7
+    if r >= 0xa0:
+        r += 0x60
+    cpu.c = r >> 8
+    r &= 0xff
+    cpu.a = r
+    cpu.z = r == 0
+    cpu.n = r >> 7
+
+def sbc_decimal(cpu, v):
+    a = cpu.a
+    binary = a - v + cpu.c - 1
+    lo = (a & 0x0f) - (v & 0x0f) + cpu.c - 1
+    r = binary
+    if r < 0:
+        r -= 0x60
+    if lo < 0:
+        r -= 0x06
+    cpu.c = binary >= 0
+    cpu.v = ((a ^ v) & (a ^ binary) & 0x80) >> 7
+    r &= 0xff
+    cpu.a = r
+    cpu.z = r == 0
+    cpu.n = r >> 7
+
+
+def _handler_namespace(bus):
+    return {'mem':bus.mem, 'io_pages':bus.io_pages, 'write_pages':bus.write_pages,
+            'io_read':bus.read, 'io_write':bus.write,
+            'adc_decimal':adc_decimal, 'sbc_decimal':sbc_decimal}
+
+def make_handlers(bus):
+    """Build the 256-entry dispatch table for a Bus."""
+    namespace = _handler_namespace(bus)
+    exec(_HANDLER_CODE, namespace)
+
+    handlers = []
+    for opcode in range(256):
+        if opcode in ISA:
+            handlers.append(namespace[f"op_{opcode:02x}"])
+        else:
+            handlers.append(_illegal_opcode_handler(opcode))
+    return handlers
+
+def _illegal_opcode_handler(opcode):
+    def illegal(cpu):
+        raise RuntimeError(f"Illegal opcode ${opcode:02x} at ${cpu.pc:04x}")
+    return illegal
+
+# ===================================================================
+# Bus
+#
+# RAM and ROM live in one flat 64 KiB bytearray. Two 256-entry page tables
+# mark the pages that need the slow path: io_pages for reads (pages with
+# devices), write_pages for writes (pages with devices or ROM, and RAM
+# with compiled code). Zero page and the stack page always take the fast
+# path.
+# ===================================================================
+
+class Bus:
+    def __init__(self):
+        self.mem = bytearray(0x10000)
+        self.io_pages = bytearray(256)
+        self.write_pages = bytearray(256)
+        self.devices = []
+        self._io = {}
+        self._rom = []
+
+        # pages with compiled blocks, and what to call when one is written
+        self.code_pages = bytearray(256)
+        self.on_code_write = None
+
+    def _check_range(self, start, end):
+        if start < 0x200 or end > 0x10000 or start >= end:
+            raise RuntimeError(f'Invalid memory range ${start:04x}-${end-1:04x} (zero page and stack can not be mapped)')
+
+    def add_rom(self, start, end=0x10000):
+        """Write protect the range [start, end)."""
+        self._check_range(start, end)
+        self._rom.append((start, end))
+        for page in range(start >> 8, ((end-1) >> 8)+1):
+            self.write_pages[page] = 1
+
+    def attach(self, device, address):
+        """Map a device (see devices.py) at address."""
+        end = address+device.size
+        self._check_range(address, end)
+        for offset in range(device.size):
+            if address+offset in self._io:
+                raise RuntimeError(f'Device at ${address:04x} overlaps another device at ${address+offset:04x}')
+            self._io[address+offset] = (device, offset)
+        for page in range(address >> 8, ((end-1) >> 8)+1):
+            self.io_pages[page] = 1
+            self.write_pages[page] = 1
+        self.devices.append((address, device))
+
+    def is_rom(self, addr):
+        return any(start <= addr < end for start,end in self._rom)
+
+    def read(self, addr):
+        entry = self._io.get(addr)
+        if entry is None:
+            return self.mem[addr]
+        device, offset = entry
+        return device.read(offset)
+
+    def write(self, addr, value):
+        entry = self._io.get(addr)
+        if entry is not None:
+            device, offset = entry
+            device.write(offset, value)
+        elif not self.is_rom(addr):
+            self.mem[addr] = value
+            if self.code_pages[addr >> 8]:
+                self.on_code_write(addr)
+
+    def load(self, prog_sections):
+        """Copy encoded program sections (see assembly.encode_program) into memory, ROM included."""
+        for section in prog_sections:
+            base = section['base_address']
+            self.mem[base:base+len(section['bytes'])] = section['bytes']
+
+# ===================================================================
+# Basic block compiler
+#
+# With compile_blocks, the CPU runs straight-line code as one generated
+# function per basic block, built from the handler snippets with pc a
+# constant for every instruction, so a single call replaces the dispatch
+# of each instruction. A block ends at the first branch or jump, at STP,
+# at CLI and PLP (which may unmask a pending IRQ), or before an opcode
+# that is not in ISA. After every instruction taking the slow path to the
+# bus the block returns early if the CPU needs attention.
+#
+# Blocks are cached by entry address. A write to a page holding compiled
+# code drops the blocks on that page, and the page is considered
+# self-modifying and interpreted from then on. Zero page and the stack
+# page are always interpreted, as writes to them bypass the page tables,
+# and so are writes to mem from outside the CPU. Code on these pages is
+# interpreted in batches in a loop as tight as CPU.run's, so programs
+# assembled at $0000 are not slowed down by looking up blocks.
+# ===================================================================
+
+MAX_BLOCK_INSTRUCTIONS = 64
+
+# more than any block can take, 7 cycles and a page crossing per instruction
+MAX_BLOCK_CYCLES = MAX_BLOCK_INSTRUCTIONS * 8
+
+# instructions interpreted at a time on pages without blocks, before
+# checking whether execution has left them
+INTERPRETED_BATCH = 64
+
+def _block_exit(next_pc, cycles, count, indent="    "):
+    return [f"{indent}cpu.pc = {next_pc:#06x}", f"{indent}return {cycles} + extra, {count}"]
+
+def block_source(mem, address, name, compilable=lambda page: True):
+    """Return (source, instruction count, end address) of the block at address.
+
+    The generated function runs the block on a CPU, leaving pc at the
+    next instruction, and returns the cycles and instructions executed.
+    compilable(page) tells whether code on a page may be included.
+    """
+    lines = [f"def {name}(cpu):", "    extra = 0"]
+    base_cycles = 0
+    count = 0
+    pc = address
+    while True:
+        opcode = mem[pc]
+        size = OPCODE_LENGTH[opcode]
+        if (size == 0 or count == MAX_BLOCK_INSTRUCTIONS or pc+size > 0x10000
+                or not compilable(pc >> 8) or not compilable((pc+size-1) >> 8)):
+            # the block ends before this instruction
+            lines += _block_exit(pc, base_cycles, count)
+            return "\n".join(lines), count, pc
+
+        mnemonic, addrmode = ISA[opcode]
+        count += 1
+        next_pc = pc + size
+        lines.append(f"    pc = {pc:#06x}")
+
+        if addrmode == "r":
+            off = mem[pc+1]
+            target = (next_pc + off - ((off & 0x80) << 1)) & 0xffff
+            taken = base_cycles + CYCLES[opcode] + ((next_pc ^ target) > 0xff)
+            if mnemonic == "BRA":
+                lines += _block_exit(target, taken, count)
+            else:
+                lines.append(f"    if {_BRANCH_CONDITIONS[mnemonic]}:")
+                lines += _block_exit(target, taken+1, count, "        ")
+                lines += _block_exit(next_pc, base_cycles + CYCLES[opcode], count)
+            return "\n".join(lines), count, next_pc
+
+        stmts, sets_pc, extra_cycles = _instruction_source(opcode)
+        lines += ["    "+s for s in stmts]
+        lines += [f"    extra += {e}" for e in extra_cycles]
+        base_cycles += CYCLES[opcode]
+
+        if sets_pc:
+            lines.append(f"    return {base_cycles} + extra, {count}")
+            return "\n".join(lines), count, next_pc
+        if mnemonic in ["STP", "CLI", "PLP"] or next_pc == 0x10000:
+            lines += _block_exit(next_pc & 0xffff, base_cycles, count)
+            return "\n".join(lines), count, next_pc
+
+        if any("io_" in s for s in stmts):
+            # a device may have raised an interrupt, or the write hit code
+            lines.append("    if cpu.attention:")
+            lines += _block_exit(next_pc, base_cycles, count, "        ")
+        pc = next_pc
+
+
+class BlockCache:
+    """Compiled basic blocks of a CPU, by entry address.
+
+    blocks maps entry addresses to block functions, or to False where the
+    code can't be compiled and is interpreted. interpreted_pages marks the
+    pages that are never compiled: zero page, the stack page and pages
+    found to be self-modifying.
+    """
+
+    _ALWAYS_INTERPRETED = bytes([1, 1]) + bytes(254)
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.bus = cpu.bus
+        self.namespace = _handler_namespace(self.bus)
+        self.blocks = {}
+        self.interpreted_pages = bytearray(self._ALWAYS_INTERPRETED)
+        self._page_blocks = [[] for _ in range(256)]
+        self._tracked_pages = set()     # RAM pages put on the slow write path for their code
+        self.bus.on_code_write = self._code_written
+
+    def _compilable(self, page):
+        return not self.interpreted_pages[page] and not self.bus.io_pages[page]
+
+    def compile(self, address):
+        """Compile the block at address, returning its function or False."""
+        name = f"block_{address:04x}"
+        source, count, end = block_source(self.bus.mem, address, name, self._compilable)
+        if count == 0:
+            self.blocks[address] = False
+            return False
+
+        exec(compile(source, f"<block ${address:04x}>", "exec"), self.namespace)
+        block = self.namespace.pop(name)
+        self.blocks[address] = block
+
+        bus = self.bus
+        for page in range(address >> 8, ((end-1) >> 8)+1):
+            self._page_blocks[page].append(address)
+            bus.code_pages[page] = 1
+            if not bus.write_pages[page]:
+                bus.write_pages[page] = 1
+                self._tracked_pages.add(page)
+        return block
+
+    def _drop_page(self, page):
+        for address in self._page_blocks[page]:
+            self.blocks.pop(address, None)
+        self._page_blocks[page] = []
+        self.bus.code_pages[page] = 0
+        if page in self._tracked_pages:
+            self._tracked_pages.remove(page)
+            self.bus.write_pages[page] = 0
+
+    def _code_written(self, addr):
+        page = addr >> 8
+        self._drop_page(page)
+        self.interpreted_pages[page] = 1
+        # leave a running block, its code may have changed
+        self.cpu.attention = True
+
+    def clear(self):
+        """Drop all blocks, as after loading new code."""
+        for page in range(256):
+            self._drop_page(page)
+        self.blocks.clear()
+        self.interpreted_pages[:] = self._ALWAYS_INTERPRETED
+
+# ===================================================================
+# CPU
+# ===================================================================
+
+class CPU:
+    def __init__(self, bus=None, compile_blocks=False):
+        if bus is None:
+            bus = Bus()
+
+        self.bus = bus
+        self.mem = bus.mem
+        self._handlers = make_handlers(bus)
+        self._blocks = BlockCache(self) if compile_blocks else None
+
+        self.a = 0
+        self.x = 0
+        self.y = 0
+        self.sp = 0xff
+        self.pc = 0
+
+        # flags, stored separately as 0/1 (or bool) values
+        self.n = 0
+        self.v = 0
+        self.d = 0
+        self.i = 1
+        self.z = 0
+        self.c = 0
+
+        self.cycles = 0
+        self.instructions = 0
+
+        self.stopped = False
+        self.irq_pending = False
+        self.nmi_pending = False
+
+        # set whenever the run loop needs to leave its fast path
+        self.attention = False
+
+    def __str__(self):
+        flags = "".join(f.upper() if getattr(self, f) else f for f in "nv") + "-b" \
+            + "".join(f.upper() if getattr(self, f) else f for f in "dizc")
+        return (f"PC={self.pc:04x} A={self.a:02x} X={self.x:02x} Y={self.y:02x} "
+                f"SP={self.sp:02x} P={flags} cycles={self.cycles}")
+
+    def get_status(self):
+        return (self.n << 7) | (self.v << 6) | 0x20 | (self.d << 3) \
+            | (self.i << 2) | (self.z << 1) | self.c
+
+    def set_status(self, p):
+        self.n = (p >> 7) & 1
+        self.v = (p >> 6) & 1
+        self.d = (p >> 3) & 1
+        self.i = (p >> 2) & 1
+        self.z = (p >> 1) & 1
+        self.c = p & 1
+
+    def read_word(self, addr):
+        return self.mem[addr] | (self.mem[(addr+1) & 0xffff] << 8)
+
+    def load(self, prog_sections):
+        self.bus.load(prog_sections)
+        if self._blocks is not None:
+            self._blocks.clear()
+
+    def reset(self):
+        self.sp = 0xfd
+        self.i = 1
+        self.d = 0
+        self.stopped = False
+        self.irq_pending = False
+        self.nmi_pending = False
+        self.attention = False
+        self.pc = self.read_word(RESET_VECTOR)
+        self.cycles += 7
+
+    def irq(self):
+        self.irq_pending = True
+        self.attention = True
+
+    def nmi(self):
+        self.nmi_pending = True
+        self.attention = True
+
+    def _interrupt(self, vector):
+        mem = self.mem
+        sp = self.sp
+        mem[0x100 | sp] = self.pc >> 8
+        mem[0x100 | (sp - 1) & 0xff] = self.pc & 0xff
+        mem[0x100 | (sp - 2) & 0xff] = self.get_status()
+        self.sp = (sp - 3) & 0xff
+        self.i = 1
+        self.d = 0
+        self.pc = self.read_word(vector)
+        self.cycles += 7
+
+    def _service(self):
+        """Handle pending interrupts and STP. Returns True if the CPU is stopped."""
+        if self.stopped:
+            # only a reset restarts a stopped CPU
+            return True
+
+        if self.nmi_pending:
+            self.nmi_pending = False
+            self._interrupt(NMI_VECTOR)
+        elif self.irq_pending and not self.i:
+            self.irq_pending = False
+            self._interrupt(IRQ_VECTOR)
+
+        # stay in the slow path while an IRQ is masked
+        self.attention = self.irq_pending
+        return False
+
+    def snapshot(self):
+        """Save the state of the CPU, memory and devices, see Snapshot."""
+        registers = tuple(getattr(self, name) for name in Snapshot.REGISTERS)
+        devices = [(address, type(device).__name__, device.get_state()) for address, device in self.bus.devices]
+        return Snapshot(registers, bytes(self.mem), devices)
+
+    def restore(self, snapshot):
+        """Return to the state saved in a snapshot, taken with the same devices attached."""
+        devices = [(address, type(device).__name__) for address, device in self.bus.devices]
+        if devices != [(address, name) for address, name, _ in snapshot.devices]:
+            raise RuntimeError('Snapshot was taken with other devices attached')
+        if len(snapshot.mem) != len(self.mem):
+            raise RuntimeError(f'Snapshot memory is {len(snapshot.mem)} bytes instead of {len(self.mem)}')
+        # check everything before changing anything
+        for (_, device), (_, _, state) in zip(self.bus.devices, snapshot.devices):
+            device.check_state(state)
+
+        for name, value in zip(Snapshot.REGISTERS, snapshot.registers):
+            setattr(self, name, value)
+        self.mem[:] = snapshot.mem
+        for (_, device), (_, _, state) in zip(self.bus.devices, snapshot.devices):
+            device.set_state(state)
+        if self._blocks is not None:
+            self._blocks.clear()
+
+    def step(self):
+        """Execute a single instruction, returning the number of cycles it took."""
+        if self.attention and self._service():
+            return 0
+        cycles = self._handlers[self.mem[self.pc]](self)
+        self.cycles += cycles
+        self.instructions += 1
+        return cycles
+
+    def run(self, max_instructions=None, max_cycles=None, profile=None):
+        """Run until STP, or until an instruction or cycle limit is reached.
+
+        With a Profile, every instruction is counted in it, and compiled
+        blocks are not used. Returns the number of instructions executed.
+        """
+        if profile is not None:
+            return self._run_profiled(profile, max_instructions, max_cycles)
+        if self._blocks is not None:
+            return self._run_blocks(max_instructions, max_cycles)
+
+        handlers = self._handlers
+        mem = self.mem
+
+        cycles = self.cycles
+        cycle_limit = (1 << 62) if max_cycles is None else cycles + max_cycles
+        instruction_limit = -1 if max_instructions is None else max_instructions
+
+        count = 0
+        while count != instruction_limit and cycles < cycle_limit:
+            if self.attention:
+                self.cycles = cycles
+                if self._service():
+                    break
+                cycles = self.cycles
+            cycles += handlers[mem[self.pc]](self)
+            count += 1
+
+        self.cycles = cycles
+        self.instructions += count
+        return count
+
+    def _run_profiled(self, profile, max_instructions, max_cycles):
+        # as run, counting every instruction by address
+        handlers = self._handlers
+        mem = self.mem
+        counts = profile.counts
+        cycle_counts = profile.cycles
+
+        cycles = self.cycles
+        cycle_limit = (1 << 62) if max_cycles is None else cycles + max_cycles
+        instruction_limit = -1 if max_instructions is None else max_instructions
+
+        count = 0
+        while count != instruction_limit and cycles < cycle_limit:
+            if self.attention:
+                self.cycles = cycles
+                if self._service():
+                    break
+                cycles = self.cycles
+            pc = self.pc
+            c = handlers[mem[pc]](self)
+            cycles += c
+            counts[pc] += 1
+            cycle_counts[pc] += c
+            count += 1
+
+        self.cycles = cycles
+        self.instructions += count
+        return count
+
+    def _run_blocks(self, max_instructions, max_cycles):
+        # as run, but through compiled blocks while they fit in the limits
+        handlers = self._handlers
+        mem = self.mem
+        blocks = self._blocks.blocks
+        compile_block = self._blocks.compile
+        interpreted_pages = self._blocks.interpreted_pages
+
+        cycles = self.cycles
+        cycle_limit = (1 << 62) if max_cycles is None else cycles + max_cycles
+        instruction_limit = (1 << 62) if max_instructions is None else max_instructions
+        block_cycle_limit = cycle_limit - MAX_BLOCK_CYCLES
+        block_instruction_limit = instruction_limit - MAX_BLOCK_INSTRUCTIONS
+
+        count = 0
+        while count < instruction_limit and cycles < cycle_limit:
+            if self.attention:
+                self.cycles = cycles
+                if self._service():
+                    break
+                cycles = self.cycles
+            pc = self.pc
+            block = blocks.get(pc)
+            if block is None:
+                block = compile_block(pc)
+            if block and count <= block_instruction_limit and cycles <= block_cycle_limit:
+                block_cycles, block_count = block(self)
+                cycles += block_cycles
+                count += block_count
+            elif interpreted_pages[pc >> 8]:
+                # no blocks to look up here, interpret as run does in
+                # batches until execution leaves these pages
+                while True:
+                    batch_end = count + INTERPRETED_BATCH
+                    if batch_end > instruction_limit:
+                        batch_end = instruction_limit
+                    while count != batch_end and cycles < cycle_limit:
+                        if self.attention:
+                            break
+                        cycles += handlers[mem[self.pc]](self)
+                        count += 1
+                    if (count != batch_end or batch_end == instruction_limit
+                            or not interpreted_pages[self.pc >> 8]):
+                        break
+            else:
+                cycles += handlers[mem[pc]](self)
+                count += 1
+
+        self.cycles = cycles
+        self.instructions += count
+        return count
+
+
+# ===================================================================
+# Profiling
+# ===================================================================
+
+class Profile:
+    """Instructions executed and cycles taken, per address of the instruction.
+
+    counts and cycles are flat arrays indexed by address, filled in by
+    CPU.run. Cycles spent entering interrupts are not counted.
+    """
+
+    def __init__(self):
+        self.counts = array('Q', bytes(8*0x10000))
+        self.cycles = array('Q', bytes(8*0x10000))
+
+    def total_cycles(self):
+        return sum(self.cycles)
+
+# ===================================================================
+# Snapshots
+#
+# A snapshot holds the registers, a copy of the 64 KiB memory and the
+# state of every device. It is never modified, so one snapshot can be
+# restored into any number of CPUs, each getting its own writable memory
+# by a single copy of the image; tracking written pages instead would
+# cost a check on every write. Snapshot files hold a fixed size header
+# with the registers, followed by the zlib compressed memory and, for
+# every device, its address, class name and state (see devices.py).
+# ===================================================================
+
+class Snapshot:
+    REGISTERS = ('a', 'x', 'y', 'sp', 'pc', 'n', 'v', 'd', 'i', 'z', 'c',
+                 'stopped', 'irq_pending', 'nmi_pending', 'attention', 'cycles', 'instructions')
+
+    def __init__(self, registers, mem, devices):
+        self.registers = registers
+        self.mem = mem
+        self.devices = devices
+
+SNAPSHOT_MAGIC = b'65C02SNP'
+SNAPSHOT_VERSION = 2
+
+# magic, version, registers, then the size of the memory data and the number of devices
+_SNAPSHOT_HEADER = struct.Struct('<8sHBBBBH10BQQII')
+
+# address, name length and state length, followed by the name and state
+_SNAPSHOT_DEVICE = struct.Struct('<IBI')
+
+def write_snapshot(snapshot, f):
+    """Write a snapshot to a binary file object."""
+    mem = zlib.compress(snapshot.mem)
+    registers = [int(value) for value in snapshot.registers]
+    f.write(_SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, *registers, len(mem), len(snapshot.devices)))
+    f.write(mem)
+    for address, name, state in snapshot.devices:
+        name = name.encode('ascii')
+        f.write(_SNAPSHOT_DEVICE.pack(address, len(name), len(state)))
+        f.write(name)
+        f.write(state)
+
+def read_snapshot(f):
+    """Read a snapshot written by write_snapshot from a binary file object."""
+    header = f.read(_SNAPSHOT_HEADER.size)
+    if len(header) != _SNAPSHOT_HEADER.size or not header.startswith(SNAPSHOT_MAGIC):
+        raise RuntimeError('Not a snapshot file')
+    magic, version, *registers, mem_size, num_devices = _SNAPSHOT_HEADER.unpack(header)
+    if version != SNAPSHOT_VERSION:
+        raise RuntimeError(f'Unsupported snapshot version {version}')
+
+    # flags come back as 0/1, which the handlers take as well as bools
+    registers[11:15] = [bool(value) for value in registers[11:15]]
+    try:
+        mem = zlib.decompress(f.read(mem_size))
+    except zlib.error:
+        raise RuntimeError('Corrupt memory image in snapshot file')
+    if len(mem) != 0x10000:
+        raise RuntimeError(f'Snapshot memory image is {len(mem)} bytes instead of 65536')
+
+    devices = []
+    for _ in range(num_devices):
+        entry = f.read(_SNAPSHOT_DEVICE.size)
+        if len(entry) != _SNAPSHOT_DEVICE.size:
+            raise RuntimeError('Truncated snapshot file')
+        address, name_size, state_size = _SNAPSHOT_DEVICE.unpack(entry)
+        name = f.read(name_size)
+        state = f.read(state_size)
+        if len(name) != name_size or len(state) != state_size:
+            raise RuntimeError('Truncated snapshot file')
+        if not name.isascii():
+            raise RuntimeError('Corrupt device name in snapshot file')
+        devices.append((address, name.decode('ascii'), state))
+    return Snapshot(tuple(registers), mem, devices)
+
+# ===================================================================
+# Headless runs
+#
+# A run is a dict with the 'name' and encoded 'sections' of a program (see
+# assembly.encode_program), and optionally the 'devices' to attach as
+# NAME or NAME@ADDRESS specs (see devices.make_device), 'serial_input'
+# bytes for the serial devices, 'rom_start', a 'snapshot' to continue
+# from instead of a reset, 'start_address', 'max_cycles',
+# 'max_instructions' and 'compile_blocks', with the same meaning as the
+# sim options.
+# ===================================================================
+
+RUN_DEFAULTS = {
+    'devices': [],
+    'serial_input': None,
+    'rom_start': None,
+    'snapshot': None,
+    'start_address': None,
+    'max_cycles': 10000000,
+    'max_instructions': None,
+    'compile_blocks': False,
+    }
+
+def device_output(bus):
+    """Lines showing what the devices on a bus have output, serial data and LCD contents."""
+    lines = []
+    for address, device in bus.devices:
+        name = type(device).__name__
+        if hasattr(device, 'output'):
+            lines.append(f"{name} at ${address:04x} output: {bytes(device.output)!r}")
+        lcd = device.lcd if isinstance(device, VIA) else device
+        if isinstance(lcd, LCD):
+            lines.append(f"{name} at ${address:04x} LCD:")
+            for line in lcd.lines():
+                lines.append(f"  |{line}|")
+    return lines
+
+
+def run_program(run):
+    """Run a program until STP or a limit is reached.
+
+    Returns a dict with the 'status', 'stopped' or 'limit', the
+    'instructions' and 'cycles' executed, the wall 'time', the final
+    'cpu' state as a string and the device 'output' lines.
+    """
+    run = {**RUN_DEFAULTS, **run}
+    bus = Bus()
+    if run['rom_start'] is not None:
+        bus.add_rom(run['rom_start'])
+
+    for spec in run['devices']:
+        device, address = make_device(spec)
+        bus.attach(device, address)
+        if run['serial_input'] and hasattr(device, 'feed'):
+            device.feed(run['serial_input'])
+
+    cpu = CPU(bus, compile_blocks=run['compile_blocks'])
+    cpu.load(run['sections'])
+    cpu.reset()
+    if run['snapshot'] is not None:
+        cpu.restore(run['snapshot'])
+    if run['start_address'] is not None:
+        cpu.pc = run['start_address']
+
+    start = time.perf_counter()
+    instructions = cpu.run(max_instructions=run['max_instructions'], max_cycles=run['max_cycles'])
+    elapsed = time.perf_counter() - start
+
+    return {
+        'status': 'stopped' if cpu.stopped else 'limit',
+        'instructions': instructions,
+        'cycles': cpu.cycles,
+        'time': elapsed,
+        'cpu': str(cpu),
+        'output': device_output(bus),
+        }
+
+
+def _run_program_safely(run):
+    """Run run_program, turning exceptions into a result with status 'error' and the 'error' message."""
+    try:
+        return run_program(run)
+    except Exception as e:
+        return {'status': 'error', 'error': format_error(e)}
+
+
+def run_programs(runs, jobs=1):
+    """Run all programs, spread over jobs worker processes if jobs > 1.
+
+    Yields (run, result) in the order of runs, see run_program, with
+    status 'error' and the 'error' message for runs that raised.
+    """
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            yield from zip(runs, pool.map(_run_program_safely, runs))
+    else:
+        for run in runs:
+            yield run, _run_program_safely(run)
@@ -109,6 +109,7 @@ ISA = {
     0x90:("BCC","r"),
     0x80:("BRA","r"),
     0x30:("BMI","r"),
+    0x50:("BVC","r"),
     0x70:("BVS","r"),
     0x10:("BPL","r"),
 
@@ -248,3 +249,104 @@ ISA = {
     # 0x82:("INV/BRL", "zp"),
 
     }
+
+# Reverse lookup tables, built once from ISA
+#
+# OPCODES:        (mnemonic, addrmode) -> opcode
+# MNEMONIC_MODES: mnemonic -> {addrmode: opcode}
+OPCODES = {}
+MNEMONIC_MODES = {}
+for _opcode, (_mnemonic, _addrmode) in ISA.items():
+    OPCODES[(_mnemonic, _addrmode)] = _opcode
+    MNEMONIC_MODES.setdefault(_mnemonic, {})[_addrmode] = _opcode
+del _opcode, _mnemonic, _addrmode
+
+def mnemonic_to_opcode(mnemonic):
+    modes = MNEMONIC_MODES.get(mnemonic, {})
+    if len(modes) != 1:
+        raise Exception(f"No unique matching instruction with mnemonic {mnemonic}: {list(modes.values())}")
+
+    return next(iter(modes.values()))
+
+# Flat 256-entry decode tables, indexed by opcode
+#
+# OPCODE_MNEMONIC: index into MNEMONICS
+# OPCODE_ADDRMODE: index into ADDRMODES
+# OPCODE_LENGTH:   instruction length in bytes, 0 for unknown opcodes
+OPERAND_SIZES = {
+    "i":0, "A":0,
+    "#":1, "r":1, "zp":1, "(zp,x)":1, "zp,x":1, "zp,y":1, "(zp)":1, "(zp),y":1,
+    "a":2, "(a,x)":2, "a,x":2, "a,y":2, "(a)":2,
+    }
+
+MNEMONICS = sorted(MNEMONIC_MODES)
+ADDRMODES = list(OPERAND_SIZES)
+
+UNKNOWN_ID = 0xff
+
+def _build_decode_tables():
+    mnemonic_ids = {m:i for i,m in enumerate(MNEMONICS)}
+    addrmode_ids = {a:i for i,a in enumerate(ADDRMODES)}
+
+    mnemonic_table = bytearray([UNKNOWN_ID]*256)
+    addrmode_table = bytearray([UNKNOWN_ID]*256)
+    length_table = bytearray(256)
+
+    for opcode, (mnemonic, addrmode) in ISA.items():
+        mnemonic_table[opcode] = mnemonic_ids[mnemonic]
+        addrmode_table[opcode] = addrmode_ids[addrmode]
+        length_table[opcode] = 1+OPERAND_SIZES[addrmode]
+
+    return bytes(mnemonic_table), bytes(addrmode_table), bytes(length_table)
+
+OPCODE_MNEMONIC, OPCODE_ADDRMODE, OPCODE_LENGTH = _build_decode_tables()
+
+# Base cycle counts on the 65C02
+#
+# CYCLES:            opcode -> base number of cycles
+# PAGE_PENALTY:      opcodes taking an extra cycle when indexing crosses a page
+# OPCODE_CYCLES:     flat 256-entry version of CYCLES, 0 for unknown opcodes
+#
+# Taken branches take one extra cycle, and one more if the branch target is
+# on another page. ADC and SBC take one extra cycle in decimal mode.
+_READ_CYCLES = {"#":2, "zp":3, "zp,x":4, "zp,y":4, "(zp)":5, "(zp,x)":6, "(zp),y":5,
+                "a":4, "a,x":4, "a,y":4}
+_STORE_CYCLES = {"zp":3, "zp,x":4, "zp,y":4, "(zp)":5, "(zp,x)":6, "(zp),y":6,
+                 "a":4, "a,x":5, "a,y":5}
+_RMW_CYCLES = {"A":2, "zp":5, "zp,x":6, "a":6, "a,x":6}
+
+_READ_MNEMONICS = ["LDA", "LDX", "LDY", "ADC", "SBC", "AND", "ORA", "EOR",
+                   "CMP", "CPX", "CPY", "BIT"]
+_STORE_MNEMONICS = ["STA", "STX", "STY", "STZ"]
+_RMW_MNEMONICS = ["INC", "DEC", "ASL", "LSR", "ROL", "ROR", "TSB"]
+
+_SPECIAL_CYCLES = {
+    ("INC","a,x"):7, ("DEC","a,x"):7,
+    ("STP","i"):3, ("INV/XCE","i"):1,
+    ("PHA","i"):3, ("PHP","i"):3, ("PHX","i"):3, ("PHY","i"):3,
+    ("PLA","i"):4, ("PLP","i"):4, ("PLX","i"):4, ("PLY","i"):4,
+    ("JSR","a"):6, ("RTS","i"):6, ("RTI","i"):6,
+    ("JMP","a"):3, ("JMP","(a)"):6, ("JMP","(a,x)"):6,
+    ("BRA","r"):3,
+    }
+
+def _base_cycles(mnemonic, addrmode):
+    if (mnemonic, addrmode) in _SPECIAL_CYCLES:
+        return _SPECIAL_CYCLES[(mnemonic, addrmode)]
+    elif mnemonic in _READ_MNEMONICS:
+        return _READ_CYCLES[addrmode]
+    elif mnemonic in _STORE_MNEMONICS:
+        return _STORE_CYCLES[addrmode]
+    elif mnemonic in _RMW_MNEMONICS:
+        return _RMW_CYCLES[addrmode]
+    else:
+        # implied instructions and not-taken branches
+        return 2
+
+CYCLES = {opcode:_base_cycles(mnemonic, addrmode) for opcode, (mnemonic, addrmode) in ISA.items()}
+
+PAGE_PENALTY = frozenset(opcode for opcode, (mnemonic, addrmode) in ISA.items()
+                         if (mnemonic in _READ_MNEMONICS and addrmode in ["a,x", "a,y", "(zp),y"])
+                         or (mnemonic in ["ASL", "LSR", "ROL", "ROR"] and addrmode == "a,x"))
+
+OPCODE_CYCLES = bytes(CYCLES.get(opcode, 0) for opcode in range(256))
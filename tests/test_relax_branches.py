@@ -0,0 +1,58 @@
+#
+# Relaxed conditional branches, run in the emulator
+#
+
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from assembly import assemble, encode_program, LONG_BRANCH_SIZE
+from emulator import CPU, Bus
+
+# branch -> (status flag bit, whether the branch is taken with it set)
+BRANCHES = {
+    'BPL': (0x80, False), 'BMI': (0x80, True),
+    'BVC': (0x40, False), 'BVS': (0x40, True),
+    'BCC': (0x01, False), 'BCS': (0x01, True),
+    'BNE': (0x02, False), 'BEQ': (0x02, True),
+    }
+
+SOURCE = '''
+.org $8000
+start:
+    LDA #${status:02x}
+    PHA
+    PLP
+    {mnemonic} far
+    LDA #$01
+    STP
+    .byte {padding}
+far:
+    LDA #$02
+    STP
+'''
+
+@pytest.mark.parametrize('compile_blocks', [False, True])
+@pytest.mark.parametrize('flag_set', [False, True])
+@pytest.mark.parametrize('mnemonic', sorted(BRANCHES))
+def test_relaxed_branch(tmp_path, mnemonic, flag_set, compile_blocks):
+    flag, taken_when_set = BRANCHES[mnemonic]
+    source = tmp_path / 'branch.s'
+    source.write_text(SOURCE.format(status=flag if flag_set else 0, mnemonic=mnemonic,
+                                    padding=', '.join(['0']*200)))
+
+    sections = assemble(source, relax=True)
+    statements = sections[0]['statements']
+    assert statements.sizes[3] == LONG_BRANCH_SIZE
+
+    cpu = CPU(Bus(), compile_blocks=compile_blocks)
+    cpu.load(encode_program(sections))
+    cpu.reset()
+    cpu.pc = 0x8000
+    cpu.run(max_instructions=100)
+
+    assert cpu.stopped
+    assert cpu.a == (2 if flag_set == taken_when_set else 1)